@@ -1,38 +1,147 @@
 # web stuff
-from flask import Flask, url_for, request, json, render_template
+from flask import (Flask, url_for, request, json, render_template, jsonify,
+                   send_file)
+import re
 import sys
 import gravitty
+from gravitty.serialize import dumps
+from gravitty.jobs import JobQueue
+from gravitty.webcache import CommunityCache, COMMUNITY_CACHE_SIZE
 
+# Number of accounts analyzed at the same time by the background workers
+JOB_PROCESSES = 1
+
+# Twitter screen names, which are also used in cache file names
+SCREEN_NAME = re.compile(r'^\w{1,15}\Z')
 
 app = Flask(__name__)
 
+job_queue = None
+
+community_cache = CommunityCache(COMMUNITY_CACHE_SIZE)
+
+
+def get_job_queue():
+    '''
+    The worker pool is only started on the first submission, so that
+    importing the app (or flask's reloader) doesn't spawn processes.
+    '''
+    global job_queue
+    if job_queue is None:
+        job_queue = JobQueue(JOB_PROCESSES)
+    return job_queue
+
+
+def load_community_json(screen_name):
+    '''
+    Serialized community json of screen_name from the in-memory cache, only
+    falling back to gravitty.load if it hasn't been analyzed. Templates
+    embed it as is.
+    '''
+    graph_json = community_cache.get_text(screen_name)
+    if graph_json is None:
+        graph_json = dumps(gravitty.load(screen_name))
+    return graph_json
+
 
 @app.route('/')
 def show_default():
-    graph_json = gravitty.load('graphlabteam')
-    available = gravitty.available()
-    available.sort()
+    graph_json = load_community_json('graphlabteam')
 
     return render_template('index.html',
                            myjson = graph_json,
-                           available_screennames = available )
+                           available_accounts = gravitty.account_summaries())
 
 @app.route('/<screen_name>')
 def get_screen_name(screen_name):
 
+    # The index of available accounts is sorted and only rescans the cache
+    # directory when it changes.
     available = gravitty.available()
-    available.sort()
+    accounts = gravitty.account_summaries()
 
     if screen_name in available or screen_name == '':
-        graph_json = gravitty.load(screen_name)
+        graph_json = load_community_json(screen_name)
         return render_template('index.html',
                                myjson = graph_json,
-                               available_screennames = available )
+                               available_accounts = accounts )
 
     else:
         return render_template('does_not_exist.html',
                                screen_name=screen_name,
-                               available_screennames = available )
+                               available_accounts = accounts )
+
+@app.route('/api/jobs/<screen_name>', methods=['POST'])
+def submit_job(screen_name):
+    '''
+    Starts analyzing screen_name in the background, unless it is already
+    available or being analyzed. Poll the GET endpoint for its status.
+    '''
+
+    if not SCREEN_NAME.match(screen_name):
+        return jsonify(screen_name=screen_name, status='invalid'), 400
+
+    if screen_name in gravitty.available():
+        return jsonify(screen_name=screen_name, status='done')
+
+    status = get_job_queue().submit(screen_name)
+
+    return jsonify(**status), 202
+
+
+@app.route('/api/jobs/<screen_name>', methods=['GET'])
+def job_status(screen_name):
+
+    if not SCREEN_NAME.match(screen_name):
+        return jsonify(screen_name=screen_name, status='invalid'), 400
+
+    status = None
+    if job_queue is not None:
+        status = job_queue.status(screen_name)
+
+    if status is None:
+        if screen_name in gravitty.available():
+            return jsonify(screen_name=screen_name, status='done')
+        return jsonify(screen_name=screen_name, status='unknown'), 404
+
+    return jsonify(**status)
+
+
+@app.route('/api/<screen_name>.json')
+def community_json_file(screen_name):
+    '''
+    Serves the serialized community json written by gravitty.load, gzipped
+    if the client accepts it. Responses carry an ETag and Last-Modified, so
+    unchanged graphs are answered with 304 Not Modified.
+    '''
+
+    if not SCREEN_NAME.match(screen_name):
+        return jsonify(screen_name=screen_name, status='invalid'), 400
+
+    fn = community_cache.json_file(screen_name)
+
+    if fn is None:
+        return jsonify(screen_name=screen_name, status='unknown'), 404
+
+    # Quality of gzip in Accept-Encoding, 0 if the client refuses it
+    # (e.g. gzip;q=0) or doesn't mention it
+    gzipped = request.accept_encodings['gzip'] > 0
+
+    response = send_file(fn + '.gz' if gzipped else fn,
+                         mimetype='application/json', conditional=True,
+                         cache_timeout=0)
+
+    if gzipped:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+
+    return response
+
+
+@app.route('/api/cache')
+def cache_stats():
+    return jsonify(**community_cache.stats())
+
 
 if __name__ == '__main__':
     if len(sys.argv) > 1:
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+
+RAW_COLUMNS = ('info', 'tweets', 'followers', 'following', 'list')
+INFO_FIELDS = ('screen_name', 'name', 'location')
+
+FORMAT_VERSION = 1
+META_FILE = 'meta.json'
+
+# Columns of complete raw objects, only written on request
+JSON_COLUMNS = ('info.json', 'tweets.json', 'list.json')
+
+
+def __save(path, name, array):
+    np.save(os.path.join(path, name + '.npy'), array)
+
+
+def __save_ints(path, name, lists):
+    '''
+    Saves a ragged column of integer lists as one int64 values array plus
+    an offsets array: row i is values[offsets[i]:offsets[i + 1]].
+    '''
+
+    lengths = [len(x) for x in lists]
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+
+    values = np.fromiter((v for x in lists for v in x), dtype=np.int64,
+                         count=offsets[-1])
+
+    __save(path, name + '.values', values)
+    __save(path, name + '.offsets', offsets)
+
+
+def __save_strings(path, name, strings):
+    ''' Saves a column of strings as utf-8 bytes plus offsets. '''
+
+    encoded = [s.encode('utf-8') if isinstance(s, unicode) else str(s)
+               for s in strings]
+
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(s) for s in encoded])
+
+    __save(path, name + '.values',
+           np.array(bytearray(''.join(encoded)), dtype=np.uint8))
+    __save(path, name + '.offsets', offsets)
+
+
+def __save_string_lists(path, name, lists):
+    ''' Saves a ragged column of string lists as a string column + offsets. '''
+
+    __save_strings(path, name + '.items', [s for x in lists for s in x])
+    __save(path, name + '.offsets',
+           np.concatenate([[0], np.cumsum([len(x) for x in lists])])
+           .astype(np.int64))
+
+
+def __dumps(obj):
+    return json.dumps(obj, default=str)
+
+
+def __user_tweets(tweets):
+    ''' Some users have no timeline at all (NaN instead of a list). '''
+    return tweets if type(tweets) == list else []
+
+
+def digest_arrays(path):
+    '''
+    return: String. md5 hex digest of every array stored in path, except
+    the optional JSON_COLUMNS.
+    '''
+
+    md5 = hashlib.md5()
+
+    for fn in sorted(os.listdir(path)):
+        if fn.endswith('.npy') and not fn.startswith(JSON_COLUMNS):
+            md5.update(fn)
+            with open(os.path.join(path, fn), 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), ''):
+                    md5.update(chunk)
+
+    return md5.hexdigest()
+
+
+def write_raw(raw_df, path, full=False):
+    '''
+    Writes the raw follower data returned by get_follower_data into a
+    directory of numpy arrays, one (or a few) per column:
+
+        ids: int64 user ids, the row order of every other column.
+        followers, following, list: int64 id arrays with per-user offsets.
+        info.<field>: screen_name, name and location as utf-8 strings.
+        tweets.offsets: per-user offsets into the tweet columns below.
+        tweets.id, tweets.text, tweets.lang: one entry per tweet.
+        tweets.hashtags, tweets.urls: strings with per-tweet offsets.
+        tweets.mentions: mentioned user ids with per-tweet offsets.
+        info.json, tweets.json, list.json: the complete raw objects, only
+        with full=True. They take as much room as all the other columns.
+
+    Every array can be memory mapped, see RawStore. Their digest is
+    computed once here and stored with the metadata.
+
+    raw_df: Pandas Dataframe from get_follower_data.
+    path: String. Directory to write to, created if needed.
+    full: Boolean. Also write the complete raw objects.
+
+    return: RawStore for path.
+    '''
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    __save(path, 'ids', np.asarray(raw_df.index, dtype=np.int64))
+
+    __save_ints(path, 'followers', raw_df['followers'].tolist())
+    __save_ints(path, 'following', raw_df['following'].tolist())
+
+    user_lists = [x if type(x) == list else [] for x in raw_df['list']]
+    __save_ints(path, 'list', [[ul['id'] for ul in x] for x in user_lists])
+    if full:
+        __save_strings(path, 'list.json', [__dumps(x) for x in user_lists])
+
+    infos = raw_df['info'].tolist()
+    for field in INFO_FIELDS:
+        __save_strings(path, 'info.' + field,
+                       [info.get(field) or u'' for info in infos])
+    if full:
+        __save_strings(path, 'info.json', [__dumps(info) for info in infos])
+
+    timelines = [__user_tweets(x) for x in raw_df['tweets']]
+    tweets = [tweet for timeline in timelines for tweet in timeline]
+
+    __save(path, 'tweets.offsets',
+           np.concatenate([[0], np.cumsum([len(x) for x in timelines])])
+           .astype(np.int64))
+    __save(path, 'tweets.id', np.array([t.get('id', 0) for t in tweets],
+                                       dtype=np.int64))
+    __save_strings(path, 'tweets.text',
+                   [t.get('text') or u'' for t in tweets])
+    __save_strings(path, 'tweets.lang',
+                   [t.get('lang') or u'' for t in tweets])
+    __save_string_lists(path, 'tweets.hashtags',
+                        [t.get('hashtags') or [] for t in tweets])
+    __save_string_lists(path, 'tweets.urls',
+                        [[u[0] for u in t.get('urls') or []] for t in tweets])
+    __save_ints(path, 'tweets.mentions',
+                [[m['id'] for m in t.get('user_mentions') or []]
+                 for t in tweets])
+    if full:
+        __save_strings(path, 'tweets.json', [__dumps(t) for t in tweets])
+
+    with open(os.path.join(path, META_FILE), 'w') as f:
+        json.dump({'version': FORMAT_VERSION, 'users': len(raw_df),
+                   'tweets': len(tweets), 'full': full,
+                   'digest': digest_arrays(path)}, f)
+
+    return RawStore(path)
+
+
+class RawStore(object):
+    '''
+    Read access to raw follower data written by write_raw. Arrays are
+    memory mapped and only loaded when a column is asked for. Pickling a
+    RawStore only pickles its path.
+
+    path: String. Directory written by write_raw.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.arrays = {}
+
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def __len__(self):
+        return self.meta['users']
+
+    def array(self, name):
+        ''' return: Memory mapped numpy array stored under name. '''
+
+        if name not in self.arrays:
+            fn = os.path.join(self.path, name + '.npy')
+            try:
+                self.arrays[name] = np.load(fn, mmap_mode='r')
+            except ValueError: # empty arrays can't be memory mapped
+                self.arrays[name] = np.load(fn)
+
+        return self.arrays[name]
+
+    def digest(self):
+        '''
+        return: String. md5 hex digest of every stored array, as recorded
+        by write_raw (computed for stores written before it was).
+        '''
+
+        if 'digest' not in self.meta:
+            self.meta['digest'] = digest_arrays(self.path)
+
+        return self.meta['digest']
+
+    @property
+    def ids(self):
+        return self.array('ids')
+
+    def ints(self, name):
+        ''' return: List of integer lists, one per row, for a ragged column. '''
+
+        values = self.array(name + '.values')
+        offsets = self.array(name + '.offsets')
+
+        return [values[offsets[i]:offsets[i + 1]].tolist()
+                for i in xrange(len(offsets) - 1)]
+
+    def strings(self, name):
+        ''' return: List of unicode strings, one per row. '''
+
+        values = self.array(name + '.values')
+        offsets = self.array(name + '.offsets')
+
+        return [values[offsets[i]:offsets[i + 1]].tostring().decode('utf-8')
+                for i in xrange(len(offsets) - 1)]
+
+    def string_lists(self, name):
+        ''' return: List of unicode string lists, one per row. '''
+
+        items = self.strings(name + '.items')
+        offsets = self.array(name + '.offsets')
+
+        return [items[offsets[i]:offsets[i + 1]]
+                for i in xrange(len(offsets) - 1)]
+
+    def __by_user(self, rows):
+        ''' Groups per-tweet rows into per-user lists. '''
+
+        offsets = self.array('tweets.offsets')
+
+        return [rows[offsets[i]:offsets[i + 1]]
+                for i in xrange(len(offsets) - 1)]
+
+    def dataframe(self, columns=RAW_COLUMNS, full=False):
+        '''
+        Rebuilds a raw dataframe (see get_follower_data) with only the
+        requested columns, e.g. for filter_dataframe and parse_dataframe.
+
+        By default, info dictionaries only hold INFO_FIELDS and tweets only
+        hold the fields parse_dataframe uses (id, text, lang, hashtags,
+        urls and user_mentions ids), read from their own columns. Use
+        full=True to decode the complete raw objects instead, if write_raw
+        was asked to store them.
+
+        columns: List of raw column names to load.
+        full: Boolean.
+
+        return: Pandas Dataframe indexed by user id.
+        '''
+
+        if full and not self.meta.get('full', True):
+            raise ValueError('%s holds no complete raw objects, write it '
+                             'with full=True' % self.path)
+
+        df = pd.DataFrame(index=pd.Index(np.asarray(self.ids), name='id'))
+
+        if 'info' in columns:
+            if full:
+                df['info'] = [json.loads(x)
+                              for x in self.strings('info.json')]
+            else:
+                fields = [self.strings('info.' + f) for f in INFO_FIELDS]
+                df['info'] = [dict(zip(INFO_FIELDS, values))
+                              for values in zip(*fields)]
+
+        if 'tweets' in columns:
+            if full:
+                tweets = [json.loads(x) for x in self.strings('tweets.json')]
+            else:
+                tweets = [{'id': tid, 'text': text, 'lang': lang,
+                           'hashtags': hashtags,
+                           'urls': [[url] for url in urls],
+                           'user_mentions': [{'id': m} for m in mentions]}
+                          for tid, text, lang, hashtags, urls, mentions
+                          in zip(self.array('tweets.id').tolist(),
+                                 self.strings('tweets.text'),
+                                 self.strings('tweets.lang'),
+                                 self.string_lists('tweets.hashtags'),
+                                 self.string_lists('tweets.urls'),
+                                 self.ints('tweets.mentions'))]
+            df['tweets'] = self.__by_user(tweets)
+
+        for column in ('followers', 'following'):
+            if column in columns:
+                df[column] = self.ints(column)
+
+        if 'list' in columns:
+            if full:
+                df['list'] = [json.loads(x) for x in self.strings('list.json')]
+            else:
+                df['list'] = [[{'id': x} for x in ids]
+                              for ids in self.ints('list')]
+
+        return df
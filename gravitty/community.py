@@ -4,7 +4,7 @@
 This module implements community detection.
 """
 from __future__ import print_function
-__all__ = ["partition_at_level", "modularity", "best_partition", "generate_dendrogram", "generate_dendogram", "induced_graph"]
+__all__ = ["partition_at_level", "partitions_at_levels", "modularity", "modularity_at_levels", "best_partition", "generate_dendrogram", "generate_dendogram", "generate_dendrograms", "most_stable", "complete_partition", "induced_graph", "graph_to_csr"]
 __author__ = """Thomas Aynaud (thomas.aynaud@lip6.fr)"""
 #    Copyright (C) 2009 by
 #    Thomas Aynaud <thomas.aynaud@lip6.fr>
@@ -15,9 +15,17 @@ __PASS_MAX = -1
 __MIN = 0.0000001
 
 import networkx as nx
+import numpy as np
+import scipy.sparse as sp
 import sys
 import types
 import array
+import time
+import random
+import multiprocessing
+
+__ENGINES = ("networkx", "array")
+__SHARED_GRAPH = None
 
 
 def partition_at_level(dendrogram, level) :
@@ -62,6 +70,83 @@ def partition_at_level(dendrogram, level) :
     return partition
 
 
+def partitions_at_levels(dendrogram, nodes) :
+    """Return the partition of the nodes at every level of the dendrogram at once
+
+    Each level is composed with the previous one, so this is linear in the depth of the dendrogram where calling partition_at_level for every level is quadratic
+
+    Parameters
+    ----------
+    dendrogram : list of dict
+       a list of partitions, ie dictionnaries where keys of the i+1 are the values of the i.
+    nodes : list
+       the nodes to return the communities of, all keys of dendrogram[0]
+
+    Returns
+    -------
+    partitions : numpy.ndarray
+       an array of shape (len(dendrogram), len(nodes)) where row i is the partition at level i, in the order of nodes
+
+    Raises
+    ------
+    KeyError
+       If the dendrogram is not well formed or a node is missing
+
+    See Also
+    --------
+    partition_at_level
+    """
+    partitions = np.empty((len(dendrogram), len(nodes)), dtype = int)
+    partitions[0] = [dendrogram[0][node] for node in nodes]
+    for index in range(1, len(dendrogram)) :
+        coms, inverse = np.unique(partitions[index - 1], return_inverse = True)
+        lookup = np.array([dendrogram[index][com] for com in coms.tolist()])
+        partitions[index] = lookup[inverse]
+    return partitions
+
+
+def modularity_at_levels(partitions, adjacency) :
+    """Compute the modularity of several partitions of a graph in one pass over its edge arrays
+
+    Parameters
+    ----------
+    partitions : numpy.ndarray
+       integer array of shape (number of partitions, number of nodes), e.g. from partitions_at_levels
+    adjacency : scipy.sparse.csr_matrix
+       the graph as returned by graph_to_csr, with rows in the same node order as partitions
+
+    Returns
+    -------
+    modularity : numpy.ndarray
+       the modularity of each partition
+
+    Raises
+    ------
+    ValueError
+        If the graph has no link
+
+    See Also
+    --------
+    modularity
+    """
+    coo = adjacency.tocoo()
+    loops = adjacency.diagonal()
+    links = (coo.data.sum() + loops.sum()) / 2.
+    if links == 0 :
+        raise ValueError("A graph without link has an undefined modularity")
+
+    # inner links are stored twice and self loops once, see graph_to_csr
+    same = partitions[:, coo.row] == partitions[:, coo.col]
+    internals = (same.dot(coo.data) + loops.sum()) / 2.
+
+    gdegrees = np.asarray(adjacency.sum(axis = 1)).ravel() + loops
+    sq_degrees = np.zeros(len(partitions))
+    for index, part in enumerate(partitions) :
+        coms = np.unique(part, return_inverse = True)[1]
+        sq_degrees[index] = (np.bincount(coms, weights = gdegrees) ** 2).sum()
+    return internals / links - sq_degrees / (4. * links * links)
+
+
 def modularity(partition, graph) :
     """Compute the modularity of a partition of a graph
 
@@ -122,7 +207,7 @@ def modularity(partition, graph) :
     return res
 
 
-def best_partition(graph, partition = None) :
+def best_partition(graph, partition = None, engine = "networkx") :
     """Compute the partition of the graph nodes which maximises the modularity
     (or try..) using the Louvain heuristices
 
@@ -135,6 +220,8 @@ def best_partition(graph, partition = None) :
        the networkx graph which is decomposed
     partition : dict, optionnal
        the algorithm will start using this partition of the nodes. It's a dictionary where keys are their nodes and values the communities
+    engine : str, optionnal
+       the louvain implementation to use, see generate_dendrogram
 
     Returns
     -------
@@ -183,16 +270,60 @@ def best_partition(graph, partition = None) :
     >>> nx.draw_networkx_edges(G,pos, alpha=0.5)
     >>> plt.show()
     """
-    dendo = generate_dendrogram(graph, partition)
+    dendo = generate_dendrogram(graph, partition, engine)
     return partition_at_level(dendo, len(dendo) - 1 )
 
 
+def complete_partition(partition, graph, strategy = "singleton") :
+    """Extend a partition of some of the graph nodes (e.g. from a previous run) to all of them, so it can be used as part_init
+
+    Parameters
+    ----------
+    partition : dict
+       a dictionary where keys are nodes and values their integer communities. Nodes that are not in the graph are dropped
+    graph : networkx.Graph
+       the networkx graph which will be decomposed
+    strategy : str, optionnal
+       "singleton" puts every missing node in a new community of its own. "neighbor" puts it in the community it is most strongly linked to, or in a new one if none of its neighbors has a community yet
+
+    Returns
+    -------
+    partition : dictionnary
+       a partition of every node of the graph
+
+    Examples
+    --------
+    >>> G = nx.karate_club_graph()
+    >>> old = best_partition(G.subgraph(range(30)))
+    >>> dendo = generate_dendrogram(G, complete_partition(old, G, "neighbor"))
+    """
+    ret = dict((node, com) for node, com in partition.items() if node in graph)
+    next_com = max(ret.values()) + 1 if ret else 0
+
+    for node in graph.nodes() :
+        if node in ret :
+            continue
+        weights = dict([])
+        if strategy == "neighbor" :
+            for neighbor, datas in graph[node].items() :
+                if neighbor in ret and neighbor != node :
+                    com = ret[neighbor]
+                    weights[com] = weights.get(com, 0.) + datas.get("weight", 1)
+        if weights :
+            ret[node] = max(weights, key = weights.get)
+        else :
+            ret[node] = next_com
+            next_com += 1
+    return ret
+
+
 def generate_dendogram(graph, part_init = None) :
     """Deprecated, use generate_dendrogram"""
     return generate_dendrogram(graph, part_init)
     
     
-def generate_dendrogram(graph, part_init = None) :
+def generate_dendrogram(graph, part_init = None, engine = "networkx",
+                        stats = None, resolution = 1., seed = None) :
     """Find communities in the graph and return the associated dendrogram
 
     A dendrogram is a tree and each level is a partition of the graph nodes.  Level 0 is the first partition, which contains the smallest communities, and the best is len(dendrogram) - 1. The higher the level is, the bigger are the communities
@@ -204,6 +335,14 @@ def generate_dendrogram(graph, part_init = None) :
         the networkx graph which will be decomposed
     part_init : dict, optionnal
         the algorithm will start using this partition of the nodes. It's a dictionary where keys are their nodes and values the communities
+    engine : str, optionnal
+        "networkx" runs on the networkx adjacency dicts. "array" converts the graph once to CSR arrays and runs with integer community ids and numpy accumulators, which is much faster on large graphs. Both return the same dendrogram format
+    stats : list, optionnal
+        if given, a dict is appended to it after every pass over the nodes, with the "level", "pass", number of "moves", "seconds" spent and the "modularity" reached
+    resolution : float, optionnal
+        the resolution of the modularity objective, i.e. the weight of the expected links term. Values above 1 favor smaller communities, values below 1 larger ones
+    seed : int, optionnal
+        if given, the nodes are visited in a random order drawn from this seed on every pass, instead of the graph order
 
     Returns
     -------
@@ -214,6 +353,8 @@ def generate_dendrogram(graph, part_init = None) :
     ------
     TypeError
         If the graph is not a networkx.Graph
+    ValueError
+        If the engine is unknown
 
     See Also
     --------
@@ -237,6 +378,14 @@ def generate_dendrogram(graph, part_init = None) :
     if type(graph) != nx.Graph :
         raise TypeError("Bad graph type, use only non directed graph")
 
+    if engine not in __ENGINES :
+        raise ValueError("Unknown engine, use one of " + str(__ENGINES))
+
+    if engine == "array" :
+        nodes, adjacency = graph_to_csr(graph)
+        return __generate_dendrogram_array(nodes, adjacency, part_init, stats,
+                                           resolution, seed)
+
     #special case, when there is no link
     #the best partition is everyone in its community
     if graph.number_of_edges() == 0 :
@@ -246,11 +395,12 @@ def generate_dendrogram(graph, part_init = None) :
         return part
 
     current_graph = graph.copy()
-    status = Status()
+    random_state = random.Random(seed) if seed is not None else None
+    status = Status(resolution)
     status.init(current_graph, part_init)
     mod = __modularity(status)
     status_list = list()
-    __one_level(current_graph, status)
+    __one_level(current_graph, status, stats, 0, random_state)
     new_mod = __modularity(status)
     partition = __renumber(status.node2com)
     status_list.append(partition)
@@ -259,7 +409,8 @@ def generate_dendrogram(graph, part_init = None) :
     status.init(current_graph)
 
     while True :
-        __one_level(current_graph, status)
+        __one_level(current_graph, status, stats, len(status_list),
+                    random_state)
         new_mod = __modularity(status)
         if new_mod - mod < __MIN :
             break
@@ -361,7 +512,7 @@ def __load_binary(data) :
     return graph
 
 
-def __one_level(graph, status) :
+def __one_level(graph, status, stats = None, level = 0, random_state = None) :
     """Compute one level of communities
     """
     modif = True
@@ -373,10 +524,17 @@ def __one_level(graph, status) :
         cur_mod = new_mod
         modif = False
         nb_pass_done += 1
+        nb_moves = 0
+        start = time.time()
 
-        for node in graph.nodes() :
+        nodes = graph.nodes()
+        if random_state is not None :
+            random_state.shuffle(nodes)
+
+        for node in nodes :
             com_node = status.node2com[node]
-            degc_totw = status.gdegrees.get(node, 0.) / (status.total_weight*2.)
+            degc_totw = (status.resolution * status.gdegrees.get(node, 0.)
+                         / (status.total_weight*2.))
             neigh_communities = __neighcom(node, graph, status)
             __remove(node, com_node,
                     neigh_communities.get(com_node, 0.), status)
@@ -391,7 +549,9 @@ def __one_level(graph, status) :
                     neigh_communities.get(best_com, 0.), status)
             if best_com != com_node :
                 modif = True
+                nb_moves += 1
         new_mod = __modularity(status)
+        __record(stats, level, nb_pass_done, nb_moves, start, new_mod)
         if new_mod - cur_mod < __MIN :
             break
 
@@ -407,14 +567,20 @@ class Status :
     internals = {}
     degrees = {}
     gdegrees = {}
+    sum_internals = 0.
+    sum_sq_degrees = 0.
+    resolution = 1.
 
-    def __init__(self) :
+    def __init__(self, resolution = 1.) :
+        self.resolution = resolution
         self.node2com = dict([])
         self.total_weight = 0
         self.degrees = dict([])
         self.gdegrees = dict([])
         self.internals = dict([])
         self.loops = dict([])
+        self.sum_internals = 0.
+        self.sum_sq_degrees = 0.
 
     def __str__(self) :
         return ("node2com : " + str(self.node2com) + " degrees : "
@@ -423,12 +589,14 @@ class Status :
 
     def copy(self) :
         """Perform a deep copy of status"""
-        new_status = Status()
+        new_status = Status(self.resolution)
         new_status.node2com = self.node2com.copy()
         new_status.internals = self.internals.copy()
         new_status.degrees = self.degrees.copy()
         new_status.gdegrees = self.gdegrees.copy()
         new_status.total_weight = self.total_weight
+        new_status.sum_internals = self.sum_internals
+        new_status.sum_sq_degrees = self.sum_sq_degrees
 
     def init(self, graph, part = None) :
         """Initialize the status of a graph with every node in one community"""
@@ -469,7 +637,9 @@ class Status :
                         else :
                             inc += float(weight) / 2.
                 self.internals[com] = self.internals.get(com, 0) + inc
-
+        self.sum_internals = float(sum(self.internals.values()))
+        self.sum_sq_degrees = float(sum(deg ** 2
+                                        for deg in self.degrees.values()))
 
 
 def __neighcom(node, graph, status) :
@@ -489,34 +659,368 @@ def __neighcom(node, graph, status) :
 
 def __remove(node, com, weight, status) :
     """ Remove node from community com and modify status"""
-    status.degrees[com] = ( status.degrees.get(com, 0.)
-                                    - status.gdegrees.get(node, 0.) )
-    status.internals[com] = float( status.internals.get(com, 0.) -
+    degree = status.degrees.get(com, 0.)
+    internal = status.internals.get(com, 0.)
+    status.degrees[com] = degree - status.gdegrees.get(node, 0.)
+    status.internals[com] = float( internal -
                 weight - status.loops.get(node, 0.) )
+    status.sum_sq_degrees += status.degrees[com] ** 2 - degree ** 2
+    status.sum_internals += status.internals[com] - internal
     status.node2com[node] = -1
 
 
 def __insert(node, com, weight, status) :
     """ Insert node into community and modify status"""
+    degree = status.degrees.get(com, 0.)
+    internal = status.internals.get(com, 0.)
     status.node2com[node] = com
-    status.degrees[com] = ( status.degrees.get(com, 0.) +
-                                status.gdegrees.get(node, 0.) )
-    status.internals[com] = float( status.internals.get(com, 0.) +
+    status.degrees[com] = degree + status.gdegrees.get(node, 0.)
+    status.internals[com] = float( internal +
                         weight + status.loops.get(node, 0.) )
+    status.sum_sq_degrees += status.degrees[com] ** 2 - degree ** 2
+    status.sum_internals += status.internals[com] - internal
 
 
 def __modularity(status) :
     """
-    Compute the modularity of the partition of the graph faslty using status precomputed
+    Compute the modularity of the partition of the graph in O(1) from the
+    running sums of internal weights and squared community degrees, which
+    __remove and __insert keep up to date
     """
     links = float(status.total_weight)
-    result = 0.
-    for community in set(status.node2com.values()) :
-        in_degree = status.internals.get(community, 0.)
-        degree = status.degrees.get(community, 0.)
-        if links > 0 :
-            result = result + in_degree / links - ((degree / (2.*links))**2)
-    return result
+    if links > 0 :
+        return (status.sum_internals / links - status.resolution
+                * status.sum_sq_degrees / (4. * links * links))
+    return 0.
+
+
+def __record(stats, level, nb_pass, nb_moves, start, mod) :
+    """Append the statistics of one pass to stats, if given"""
+    if stats is not None :
+        stats.append({"level" : level, "pass" : nb_pass,
+                      "moves" : nb_moves, "seconds" : time.time() - start,
+                      "modularity" : mod})
+
+
+def graph_to_csr(graph) :
+    """Convert a graph to CSR arrays
+
+    Parameters
+    ----------
+    graph : networkx.Graph
+        the networkx graph to convert
+
+    Returns
+    -------
+    nodes : list
+        the graph nodes, in the order of the matrix rows
+    adjacency : scipy.sparse.csr_matrix
+        the symmetric weighted adjacency matrix. Self loops are stored once on the diagonal, so the weighted degree of node i is the sum of row i plus adjacency[i, i]
+
+    Raises
+    ------
+    ValueError
+        If the graph has negative weights
+    """
+    nodes = graph.nodes()
+    position = dict((node, index) for index, node in enumerate(nodes))
+    rows, cols, weights = [], [], []
+
+    for node1, node2, datas in graph.edges_iter(data = True) :
+        weight = datas.get("weight", 1)
+        if weight < 0 :
+            raise ValueError("Bad graph type, use positive weights")
+        rows.append(position[node1])
+        cols.append(position[node2])
+        weights.append(weight)
+        if node1 != node2 :
+            rows.append(position[node2])
+            cols.append(position[node1])
+            weights.append(weight)
+
+    adjacency = sp.csr_matrix((np.asarray(weights, dtype = float),
+                               (rows, cols)), shape = (len(nodes),) * 2)
+    return nodes, adjacency
+
+
+class ArrayStatus :
+    """
+    Status of the array engine. Nodes are rows of the adjacency matrix and communities are integers in [0, n)
+    """
+
+    def __init__(self, adjacency, part = None, resolution = 1.) :
+        """Initialize the status with every node in its own community, or
+        with the communities of part (an integer array)"""
+        size = adjacency.shape[0]
+        self.resolution = resolution
+        self.indptr = adjacency.indptr
+        self.indices = adjacency.indices
+        self.weights = adjacency.data
+        self.loops = adjacency.diagonal()
+        self.gdegrees = np.asarray(adjacency.sum(axis = 1)).ravel() + self.loops
+        self.total_weight = (adjacency.sum() + self.loops.sum()) / 2.
+
+        if part is None :
+            self.node2com = np.arange(size)
+            self.degrees = self.gdegrees.copy()
+            self.internals = self.loops.copy()
+        else :
+            self.node2com = np.asarray(part).copy()
+            self.degrees = np.bincount(self.node2com, weights = self.gdegrees,
+                                       minlength = size)
+            coo = adjacency.tocoo()
+            same = ((self.node2com[coo.row] == self.node2com[coo.col])
+                    & (coo.row != coo.col))
+            self.internals = np.bincount(self.node2com[coo.row[same]],
+                                         weights = coo.data[same] / 2.,
+                                         minlength = size)
+            self.internals += np.bincount(self.node2com, weights = self.loops,
+                                          minlength = size)
+        self.sum_internals = float(self.internals.sum())
+        self.sum_sq_degrees = float((self.degrees ** 2).sum())
+
+
+def __generate_dendrogram_array(nodes, adjacency, part_init = None,
+                                stats = None, resolution = 1., seed = None) :
+    """Louvain method on CSR arrays, see generate_dendrogram
+    """
+    #special case, when there is no link
+    #the best partition is everyone in its community
+    if adjacency.nnz == 0 :
+        return [dict((node, node) for node in nodes)]
+
+    part = None
+    if part_init is not None :
+        part = __renumber_array(np.array([part_init[node] for node in nodes]))
+
+    random_state = np.random.RandomState(seed) if seed is not None else None
+    status = ArrayStatus(adjacency, part, resolution)
+    status_list = list()
+    __one_level_array(status, stats, 0, random_state)
+    partition = __renumber_array(status.node2com)
+    status_list.append(dict(zip(nodes, partition.tolist())))
+    mod = __modularity_array(status)
+    adjacency = __induced_csr(partition, adjacency)
+    status = ArrayStatus(adjacency, resolution = resolution)
+
+    while True :
+        __one_level_array(status, stats, len(status_list), random_state)
+        new_mod = __modularity_array(status)
+        if new_mod - mod < __MIN :
+            break
+        partition = __renumber_array(status.node2com)
+        status_list.append(dict(enumerate(partition.tolist())))
+        mod = new_mod
+        adjacency = __induced_csr(partition, adjacency)
+        status = ArrayStatus(adjacency, resolution = resolution)
+    return status_list[:]
+
+
+def __induced_csr(partition, adjacency) :
+    """Array version of induced_graph, the communities of partition become
+    the nodes of the returned adjacency matrix
+    """
+    size = adjacency.shape[0]
+    num_coms = partition.max() + 1
+    members = sp.csr_matrix((np.ones(size), (np.arange(size), partition)),
+                            shape = (size, num_coms))
+    induced = (members.T * adjacency * members).tocsr()
+    # inner links are counted from both ends, self loops only once
+    loops = members.T * adjacency.diagonal()
+    diagonal = induced.diagonal()
+    return (induced + sp.diags((loops - diagonal) / 2., 0)).tocsr()
+
+
+def __renumber_array(node2com) :
+    """Renumber communities from 0 to n in order of first appearance, like
+    __renumber
+    """
+    coms, first, inverse = np.unique(node2com, return_index = True,
+                                     return_inverse = True)
+    order = np.empty(len(coms), dtype = int)
+    order[np.argsort(first)] = np.arange(len(coms))
+    return order[inverse]
+
+
+def __one_level_array(status, stats = None, level = 0, random_state = None) :
+    """Compute one level of communities, array version of __one_level
+    """
+    modif = True
+    nb_pass_done = 0
+    cur_mod = __modularity_array(status)
+    new_mod = cur_mod
+    two_m = status.total_weight * 2.
+    degrees = status.degrees
+    internals = status.internals
+
+    while modif  and nb_pass_done != __PASS_MAX :
+        cur_mod = new_mod
+        modif = False
+        nb_pass_done += 1
+        nb_moves = 0
+        start = time.time()
+
+        nodes = np.arange(len(status.node2com))
+        if random_state is not None :
+            random_state.shuffle(nodes)
+
+        for node in nodes :
+            com_node = status.node2com[node]
+            degc_totw = status.resolution * status.gdegrees[node] / two_m
+            lo, hi = status.indptr[node], status.indptr[node + 1]
+            neighbors = status.indices[lo:hi]
+            others = neighbors != node
+            neigh_coms, inverse = np.unique(
+                status.node2com[neighbors[others]], return_inverse = True)
+            neigh_weights = np.bincount(
+                inverse, weights = status.weights[lo:hi][others])
+
+            own = np.flatnonzero(neigh_coms == com_node)
+            own_weight = neigh_weights[own[0]] if len(own) else 0.
+            old_degree = degrees[com_node]
+            degrees[com_node] -= status.gdegrees[node]
+            internals[com_node] -= own_weight + status.loops[node]
+            status.sum_sq_degrees += degrees[com_node] ** 2 - old_degree ** 2
+            status.sum_internals -= own_weight + status.loops[node]
+
+            best_com = com_node
+            best_weight = own_weight
+            if len(neigh_coms) :
+                incr = neigh_weights - degrees[neigh_coms] * degc_totw
+                best = incr.argmax()
+                if incr[best] > 0 :
+                    best_com = neigh_coms[best]
+                    best_weight = neigh_weights[best]
+
+            status.node2com[node] = best_com
+            old_degree = degrees[best_com]
+            degrees[best_com] += status.gdegrees[node]
+            internals[best_com] += best_weight + status.loops[node]
+            status.sum_sq_degrees += degrees[best_com] ** 2 - old_degree ** 2
+            status.sum_internals += best_weight + status.loops[node]
+            if best_com != com_node :
+                modif = True
+                nb_moves += 1
+        new_mod = __modularity_array(status)
+        __record(stats, level, nb_pass_done, nb_moves, start, new_mod)
+        if new_mod - cur_mod < __MIN :
+            break
+
+
+def __modularity_array(status) :
+    """
+    Compute the modularity of the partition in O(1) from the running sums
+    kept by __one_level_array, see __modularity
+    """
+    links = float(status.total_weight)
+    if links > 0 :
+        return (status.sum_internals / links - status.resolution
+                * status.sum_sq_degrees / (4. * links * links))
+    return 0.
+
+
+def generate_dendrograms(graph, resolutions = (1.,), seeds = (None,),
+                         processes = None, part_init = None) :
+    """Run the louvain method (array engine) once for every combination of resolution and node order seed, in a process pool, and score how stable each result is
+
+    The graph is converted to CSR arrays once. Workers are forked after that, so they share it read-only instead of receiving a pickled copy
+
+    Parameters
+    ----------
+    graph : networkx.Graph
+        the networkx graph which will be decomposed
+    resolutions : list of float, optionnal
+        the resolutions to try, see generate_dendrogram
+    seeds : list of int, optionnal
+        the node order seeds to try, None being the graph order
+    processes : int, optionnal
+        size of the process pool, the number of cpus by default. Use 1 to run in this process
+    part_init : dict, optionnal
+        the partition every run will start from, see generate_dendrogram
+
+    Returns
+    -------
+    candidates : list of dict
+        one dict per run with its "resolution", "seed", "dendrogram", "modularity" (of the last level, at resolution 1) and "stability", the mean normalized mutual information between the last level of this run and of every other run
+
+    See Also
+    --------
+    most_stable
+    """
+    global __SHARED_GRAPH
+
+    if type(graph) != nx.Graph :
+        raise TypeError("Bad graph type, use only non directed graph")
+
+    nodes, adjacency = graph_to_csr(graph)
+    runs = [(resolution, seed) for resolution in resolutions
+            for seed in seeds]
+
+    __SHARED_GRAPH = (nodes, adjacency, part_init)
+    try :
+        if processes == 1 or len(runs) == 1 :
+            dendrograms = [__run_shared(run) for run in runs]
+        else :
+            pool = multiprocessing.Pool(processes)
+            try :
+                dendrograms = pool.map(__run_shared, runs)
+            finally :
+                pool.close()
+                pool.join()
+    finally :
+        __SHARED_GRAPH = None
+
+    parts = [__compose(dendo, nodes) for dendo in dendrograms]
+    candidates = list()
+    for index, (resolution, seed) in enumerate(runs) :
+        others = [__nmi(parts[index], part)
+                  for other, part in enumerate(parts) if other != index]
+        candidates.append({"resolution" : resolution, "seed" : seed,
+                           "dendrogram" : dendrograms[index],
+                           "modularity" : __csr_modularity(adjacency,
+                                                           parts[index]),
+                           "stability" : np.mean(others) if others else 1.})
+    return candidates
+
+
+def most_stable(candidates) :
+    """Return the candidate of generate_dendrograms with the highest stability, using modularity to break ties"""
+    return max(candidates,
+               key = lambda cand : (cand["stability"], cand["modularity"]))
+
+
+def __run_shared(run) :
+    """Process pool worker, runs the array engine on the shared graph"""
+    resolution, seed = run
+    nodes, adjacency, part_init = __SHARED_GRAPH
+    return __generate_dendrogram_array(nodes, adjacency, part_init,
+                                       resolution = resolution, seed = seed)
+
+
+def __compose(dendrogram, nodes) :
+    """Communities of the nodes at the last level of the dendrogram, as an integer array"""
+    return __renumber_array(partitions_at_levels(dendrogram, nodes)[-1])
+
+
+def __csr_modularity(adjacency, part, resolution = 1.) :
+    """Modularity of the integer partition part of the CSR graph adjacency"""
+    status = ArrayStatus(adjacency, part, resolution)
+    return __modularity_array(status)
+
+
+def __nmi(part1, part2) :
+    """Normalized mutual information between two integer partitions"""
+    size = float(len(part1))
+    joint = sp.coo_matrix((np.ones(len(part1)), (part1, part2))).tocsr().tocoo()
+    p_joint = joint.data / size
+    p_1 = np.bincount(part1) / size
+    p_2 = np.bincount(part2) / size
+    mutual = (p_joint * np.log(p_joint / (p_1[joint.row] * p_2[joint.col]))).sum()
+    p_1, p_2 = p_1[p_1 > 0], p_2[p_2 > 0]
+    entropy = -(p_1 * np.log(p_1)).sum() - (p_2 * np.log(p_2)).sum()
+    if entropy == 0 :
+        return 1.
+    return 2. * mutual / entropy
 
 
 def main() :
@@ -2,7 +2,7 @@
 import graphlab as gl
 import networkx as nx
 import numpy as np
-from community import modularity, partition_at_level
+from community import graph_to_csr, partitions_at_levels, modularity_at_levels
 import happy
 import d3py
 
@@ -236,17 +236,26 @@ def get_community_assignment(in_df, graph, dendrogram):
 
     community_modularity = {}
 
-    for i in range(len(dendrogram)):
+    # Compose every level of the dendrogram at once and get the modularity
+    # of all of them from a single pass over the graph's edge arrays.
+    nodes, adjacency = graph_to_csr(graph)
+    partitions = partitions_at_levels(dendrogram, nodes)
+    level_modularity = modularity_at_levels(partitions, adjacency)
+
+    # Infrequently, the community detection algorithm will exclude (?) a
+    # a user ID or two. Still investgating why. For now, these will be
+    # placed into partition 0.
+    position = {node: i for i, node in enumerate(nodes)}
+    rows = np.array([position.get(ind, -1) for ind in df.index], dtype=int)
+    found = rows >= 0
 
-        partition = partition_at_level(dendrogram, i)
+    for i in range(len(dendrogram)):
 
-        # Infrequently, the community detection algorithm will exclude (?) a
-        # a user ID or two. Still investgating why. For now, these will be
-        # placed into partition 0.
-        df['cid' + str(i)] = [partition[ind] if ind in partition else 0
-                              for ind in df.index]
+        cids = np.zeros(len(rows), dtype=int)
+        cids[found] = partitions[i][rows[found]]
+        df['cid' + str(i)] = cids
 
-        community_modularity[i] = modularity(partition, graph)
+        community_modularity[i] = float(level_modularity[i])
 
     return df, community_modularity
 
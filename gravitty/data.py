@@ -1,12 +1,39 @@
 # -*- coding: utf-8 -*-
 import pandas as pd
+import threading
 import twitter
 import time
+from multiprocessing.pool import ThreadPool
+from scheduler import ApiScheduler
 
 URLS = ('url', 'urls')
 FOLLOWERS_CAP = 50000
 FOLLOWING_CAP = 50000
 
+# Follower and friend ids are fetched one page (cursor) at a time, and each
+# page is checkpointed in the cursors collection until the crawl completes.
+ID_URLS = {'followers': 'followers/ids.json',
+           'following': 'friends/ids.json',
+           }
+ID_PAGE_SIZE = 5000
+CURSOR_INDEX = [('id', 1), ('type', 1), ('page', 1)]
+
+CACHE_INDEX = [('id', 1), ('type', 1)]
+CACHE_BATCH_SIZE = 500
+CACHE_FLUSH_SECONDS = 30
+CACHE_READ_BATCH_SIZE = 1000
+NUM_DATA_TYPES = 5
+
+# Incremental updates: cached data older than its maximum age (in seconds)
+# is refetched, and at most TWEETS_CAP of a user's newest tweets are kept.
+MAX_AGE = {'list': 7 * 24 * 3600,
+           'following': 7 * 24 * 3600,
+           'followers': 7 * 24 * 3600,
+           'tweets': 24 * 3600,
+           'info': 24 * 3600,
+           }
+TWEETS_CAP = 200
+
 API_CALLS = {'list': 'GetListsList',
              'following': 'GetFriendIDs',
              'followers':'GetFollowerIDs',
@@ -43,13 +70,113 @@ def __traverse(in_dict, lookup):
     return d
 
 
-def __get_cache(db, followers):
+def is_stale(updated, data_type, now=None):
+    '''
+    updated: Float. Time the cached data was written (None if unknown, e.g.
+    data cached before updates were tracked).
+    data_type: String.
+
+    return: Boolean. True if the data is older than MAX_AGE for its type.
+    '''
+    if updated is None:
+        return True
+
+    if now is None:
+        now = time.time()
+
+    return now - updated > MAX_AGE[data_type]
+
+
+def __newest_id(tweets):
+    ''' return: Highest tweet id in a list of tweet dicts, or None. '''
+    ids = [t['id'] for t in tweets if 'id' in t]
+    return max(ids) if ids else None
+
+
+def __merge_tweets(new, old, cap=TWEETS_CAP):
+    '''
+    Prepends newly fetched tweets to a cached timeline, dropping duplicates
+    and keeping the newest cap tweets.
+    '''
+    seen = set(t.get('id') for t in new)
+    return (new + [t for t in old if t.get('id') not in seen])[:cap]
+
+
+def ensure_cache_index(db):
+    '''
+    Creates the compound (id, type) index that every cache lookup uses, and
+    the index of the id crawl checkpoints, if they do not exist yet. Returns
+    nothing.
+    '''
+    db.data.ensure_index(CACHE_INDEX)
+    db.cursors.ensure_index(CURSOR_INDEX)
+
+
+class CacheWriter(object):
+    '''
+    Buffers cache writes and sends them to mongo as one unordered bulk
+    upsert, once batch_size writes are pending or flush_seconds have passed
+    since the last flush. Safe to share between threads. Call flush() when
+    done to write whatever is left.
+
+    db: Mongodb database object.
+    batch_size: Integer. Maximum number of pending writes.
+    flush_seconds: Float. Maximum time between flushes.
+    '''
+
+    def __init__(self, db, batch_size=CACHE_BATCH_SIZE,
+                 flush_seconds=CACHE_FLUSH_SECONDS):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.pending = {}
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+
+    def write(self, data, user_id, cache_type, fields=None):
+        '''
+        Queue data for user/type, flushing if the batch is due. fields is a
+        dictionary of extra fields to set on the document, if any.
+        '''
+        document = {'data': data, 'updated': time.time()}
+        document.update(fields or {})
+
+        with self.lock:
+            self.pending[(user_id, cache_type)] = document
+
+            if len(self.pending) >= self.batch_size or \
+                    time.time() - self.last_flush >= self.flush_seconds:
+                self.__flush()
+
+    def flush(self):
+        ''' Write all pending data. '''
+        with self.lock:
+            self.__flush()
+
+    def __flush(self):
+        if self.pending:
+            bulk = self.db.data.initialize_unordered_bulk_op()
+
+            for (user_id, cache_type), document in self.pending.iteritems():
+                bulk.find({'id': user_id, 'type': cache_type}) \
+                    .upsert().update({'$set': document})
+
+            bulk.execute()
+            self.pending = {}
+
+        self.last_flush = time.time()
+
+
+def __get_cache(db, followers, types=None, with_data=True):
     '''
     Mass collection of cached data. Get all documents from the database that
     have an id in followers.
 
     db: Mongodb database object.
     followers: List of followers. Each element should be a user id integer.
+    types: List of data types to get. Defaults to all of them.
+    with_data: Boolean. If false, only find which data types are cached;
+    every value is the time that data was last updated (None if unknown).
 
     return: Nested Dictionary with found/cached user_ids as parent keys.
     Each user_id is mapped to a dictionary of data type - value pairs.
@@ -57,7 +184,17 @@ def __get_cache(db, followers):
 
     result = {}
 
-    curs = db.data.find({'id': {'$in': followers}}, timeout=False)
+    query = {'id': {'$in': followers}}
+
+    if types is not None:
+        query['type'] = {'$in': list(types)}
+
+    fields = {'_id': False, 'id': True, 'type': True, 'updated': True}
+
+    if with_data:
+        fields['data'] = True
+
+    curs = db.data.find(query, fields=fields, timeout=False)
 
     for data in curs:
 
@@ -68,20 +205,134 @@ def __get_cache(db, followers):
         if uid not in result:
             result[uid] = {}
 
-        result[uid][dtype] = data['data']
+        result[uid][dtype] = data.get('data' if with_data else 'updated')
 
     curs.close()
 
     return result
 
 
-def __get_cache_for_user(db, user_id, cache_type):
+def iter_cache(db, user_ids, types=None, with_data=True,
+               batch_size=CACHE_READ_BATCH_SIZE):
+    '''
+    Streams cached data for many users, batch_size users per query, so
+    neither the query nor its results have to hold every user at once.
+
+    db: Mongodb database object.
+    user_ids: List of user id integers.
+    types: List of data types to get. Defaults to all of them.
+    with_data: Boolean. If false, only find which data types are cached
+    and when they were last updated.
+    batch_size: Integer. Number of users per query.
+
+    return: Generator of nested dictionaries (see __get_cache), one per
+    batch of users.
+    '''
+
+    for start in xrange(0, len(user_ids), batch_size):
+        yield __get_cache(db, user_ids[start:start + batch_size], types,
+                          with_data)
+
+
+def __call_api(api, method, function, *args):
+    '''
+    Calls function(api, *args), through the scheduler if api is an
+    ApiScheduler so that it counts against the rate limit of method.
+    '''
+    if isinstance(api, ApiScheduler):
+        return api.call(method, function, *args)
+
+    return function(api, *args)
+
+
+def __get_id_page(api, data_type, user_id, screen_name, cursor):
+    '''
+    Get one page of follower/friend ids. The twitter module's GetFollowerIDs
+    and GetFriendIDs walk every page (sleeping in between) without exposing
+    the cursor, so the request is made directly.
+
+    return: Tuple of the list of ids and the next cursor (0 after the last
+    page).
+    '''
+
+    parameters = {'cursor': cursor, 'count': ID_PAGE_SIZE}
+
+    if user_id is not None:
+        parameters['user_id'] = user_id
+
+    if screen_name is not None:
+        parameters['screen_name'] = screen_name
+
+    url = '%s/%s' % (api.base_url, ID_URLS[data_type])
+    json = api._RequestUrl(url, 'GET', data=parameters)
+    data = api._ParseAndCheckTwitter(json.content)
+
+    return data['ids'], data.get('next_cursor', 0)
+
+
+def get_ids(db, api, user_id, data_type, screen_name=None, count=None):
+    '''
+    Get all follower (or friend) ids of a user, page by page. Every page
+    followed by another one is checkpointed in the cursors collection along
+    with the cursor of the next page, so an interrupted crawl resumes where
+    it stopped rather than starting over. Checkpoints older than MAX_AGE
+    for the data type are discarded. Checkpoints are removed once the crawl
+    completes.
+
+    Most users fit in a single page, which costs no checkpoint writes. If
+    count says so, the checkpoints aren't even looked up.
+
+    db: Mongodb database object.
+    api: Twitter api object or ApiScheduler.
+    user_id: Integer.
+    data_type: String. 'followers' or 'following'.
+    screen_name: String, Optional.
+    count: Integer. Expected number of ids (e.g. the user's followers_count
+    for followers), Optional.
+
+    return: List of user ids.
+    '''
+
+    key = {'id': user_id, 'type': data_type}
+    pages = []
+
+    if count is None or count > ID_PAGE_SIZE:
+        pages = list(db.cursors.find(key, sort=[('page', 1)]))
+
+        if pages and is_stale(pages[0].get('updated'), data_type):
+            db.cursors.remove(key)
+            pages = []
+
+    ids = [uid for page in pages for uid in page['ids']]
+    cursor = pages[-1]['cursor'] if pages else -1
+
+    while cursor != 0:
+        page_ids, cursor = __call_api(api, API_CALLS[data_type],
+                                      __get_id_page, data_type, user_id,
+                                      screen_name, cursor)
+        ids += page_ids
+
+        if cursor != 0:
+            page = dict(key, page=len(pages), ids=page_ids, cursor=cursor,
+                        updated=time.time())
+            db.cursors.insert(page)
+            pages.append(page)
+
+    if pages:
+        db.cursors.remove(key)
+
+    return ids
+
+
+def __get_cache_for_user(db, user_id, cache_type, document=False):
     '''
     Query database for specific User ID and data type.
 
     db: Mongo database object
     user_id: Integer
     cache_type: String
+    document: Boolean. If true, return the whole cached document (data,
+    updated and since_id for tweets) rather than only its data.
 
     return: Data from cache (No specified type). If not in cache, returns None
     '''
@@ -89,24 +340,43 @@ def __get_cache_for_user(db, user_id, cache_type):
     if user_id:
         tmp = db.data.find_one({'id': user_id, 'type': cache_type})
         if tmp:
-            return tmp['data']
+            return tmp if document else tmp['data']
     return None
 
 
-def __make_cache_for_user(db, data, user_id, cache_type):
-    ''' Write data for user/type in database. Returns nothing. '''
+def __make_cache_for_user(db, data, user_id, cache_type, writer=None,
+                          fields=None):
+    '''
+    Write data for user/type in database, or queue it in writer (a
+    CacheWriter) if given, along with the time of the update and any extra
+    fields. Returns nothing.
+    '''
+    if writer is not None:
+        writer.write(data, user_id, cache_type, fields)
+        return
+
+    document = {'data': data, 'updated': time.time()}
+    document.update(fields or {})
+
     db.data.update({'id': user_id, 'type': cache_type},
-                   {'$set': {'data': data}},
+                   {'$set': document},
                    upsert = True)
 
 
 def get_user_data_by_type(db, api, screen_name=None,
-                          user_id=None, data_type=None, force=False):
+                          user_id=None, data_type=None, force=False,
+                          cached=None, writer=None, incremental=False,
+                          count=None):
     '''
     Get data for a specific user, for a specific data type. If force is
     True, data will be pulled from twitter regardless of whether it has
     previously been cached and will replace the cached data.
 
+    If incremental is True, cached data older than MAX_AGE for its type is
+    refetched. Stale timelines are not downloaded again: only tweets newer
+    than the newest cached one are fetched (via since_id) and merged into
+    the cached timeline, keeping the newest TWEETS_CAP tweets.
+
     db: mongo database object
     api: twitter api object
     screen_name: String, Optional.
@@ -114,11 +384,38 @@ def get_user_data_by_type(db, api, screen_name=None,
     data_type: String. Data type to query for
     force: Boolean. If true will query twitter regardless of whether cache
     exists.
+    cached: Dictionary of data type - value pairs already read from the
+    cache for this user (e.g. by a bulk read). If given, the cache is not
+    queried again. Optional.
+    writer: CacheWriter used to batch the cache write. Optional.
+    incremental: Boolean. If true, refetch stale data (see above).
+    count: Integer. Expected number of follower/friend ids, see get_ids.
+    Optional.
 
     return: List/Dictionary based on data type selection.
     '''
 
-    data = None if force else __get_cache_for_user(db, user_id, data_type)
+    old_tweets = None
+    args = dict(API_ARGS[data_type])
+
+    if force:
+        data = None
+    elif cached is not None:
+        data = cached.get(data_type)
+    elif incremental:
+        doc = __get_cache_for_user(db, user_id, data_type, document=True)
+        data = None
+
+        if doc is not None and not is_stale(doc.get('updated'), data_type):
+            data = doc['data']
+
+        elif doc is not None and data_type == 'tweets':
+            old_tweets = doc['data']
+            since_id = doc.get('since_id') or __newest_id(old_tweets)
+            if since_id is not None:
+                args['since_id'] = since_id
+    else:
+        data = __get_cache_for_user(db, user_id, data_type)
 
     if data == None:
         try:
@@ -126,10 +423,16 @@ def get_user_data_by_type(db, api, screen_name=None,
             # methods (or declare them in a dict at the top of the page),
             # we must resort to building up the function call as a string
             # and evaluating it, otherwise this part of the function would
-            # contain a lot of if-else statements.
-            data = eval('api.' + API_CALLS[data_type] + \
-                        '(screen_name=screen_name, user_id=user_id, ' + \
-                        '**API_ARGS[data_type])')
+            # contain a lot of if-else statements. Ids are paged through
+            # separately so that the crawl can be resumed.
+            if data_type in ID_URLS:
+                data = get_ids(db, api, user_id, data_type, screen_name,
+                               count)
+
+            else:
+                data = eval('api.' + API_CALLS[data_type] + \
+                            '(screen_name=screen_name, user_id=user_id, ' + \
+                            '**args)')
 
         except twitter.error.TwitterError as e:
             raise e
@@ -143,18 +446,30 @@ def get_user_data_by_type(db, api, screen_name=None,
         elif data_type == 'info':
             data = __traverse(data.AsDict(), URLS)
 
-        __make_cache_for_user(db, data, user_id, data_type)
+        fields = None
+
+        if data_type == 'tweets':
+            if old_tweets is not None:
+                data = __merge_tweets(data, old_tweets)
+
+            fields = {'since_id': __newest_id(data)}
+
+        __make_cache_for_user(db, data, user_id, data_type, writer, fields)
 
     return data
 
 
-def get_user_data(db, api, name=None, uid=None, ctr=0, force=False):
+def get_user_data(db, api, name=None, uid=None, ctr=0, force=False,
+                  cached=None, writer=None, incremental=False,
+                  followers_cap=FOLLOWERS_CAP, following_cap=FOLLOWING_CAP):
     '''
     Get all data types for a given user. If user is protected/suspended,
     returns None. If user has too many friends or followers, specified by
-    constants FOLLOWERS_CAP and FOLLOWING_CAP, respectively, returns None.
-    Without this constraint, rate limits are hit arbitrarily trying to query
-    friends/followers at 5k ID's per time (twitter api's limit).
+    followers_cap and following_cap, respectively, returns None. Without
+    this constraint, rate limits are hit arbitrarily trying to query
+    friends/followers at 5k ID's per time (twitter api's limit). Raise the
+    caps (or pass None) to crawl large accounts; their id crawls are
+    checkpointed and resume if interrupted (see get_ids).
 
     db: Mongodb database object
     api: Twitter api object
@@ -163,6 +478,13 @@ def get_user_data(db, api, name=None, uid=None, ctr=0, force=False):
     ctr: Rate Limit Retry Counter. Do not use.
     force: Boolean. If true will query twitter regardless of whether cache
     exists.
+    cached: Dictionary of data type - value pairs already read from the
+    cache for this user. Optional.
+    writer: CacheWriter used to batch cache writes. Optional.
+    incremental: Boolean. If true, refetch stale data, fetching only new
+    tweets (see get_user_data_by_type).
+    followers_cap: Integer. Maximum number of followers, or None.
+    following_cap: Integer. Maximum number of friends, or None.
 
     return: tuple of lists/dictionaries or None
     '''
@@ -171,27 +493,40 @@ def get_user_data(db, api, name=None, uid=None, ctr=0, force=False):
     try:
         target = get_user_data_by_type(db, api, screen_name=name,
                                        user_id=uid, data_type='info',
-                                       force=force)
+                                       force=force, cached=cached,
+                                       writer=writer, incremental=incremental)
 
-        if 'followers_count' in target:
-            if target['followers_count'] > FOLLOWERS_CAP:
+        if 'followers_count' in target and followers_cap is not None:
+            if target['followers_count'] > followers_cap:
                 return None
 
-        if 'friends_count' in target:
-            if target['friends_count'] > FOLLOWING_CAP:
+        if 'friends_count' in target and following_cap is not None:
+            if target['friends_count'] > following_cap:
                 return None
 
         tweets = get_user_data_by_type(db, api, user_id=target['id'],
-                                       data_type='tweets', force=force)
+                                       data_type='tweets', force=force,
+                                       cached=cached, writer=writer,
+                                       incremental=incremental)
 
         user_lists = get_user_data_by_type(db, api, user_id=target['id'],
-                                           data_type='list', force=force)
+                                           data_type='list', force=force,
+                                           cached=cached, writer=writer,
+                                           incremental=incremental)
 
         followers = get_user_data_by_type(db, api, user_id=target['id'],
-                                          data_type='followers', force=force)
+                                          data_type='followers',
+                                          force=force, cached=cached,
+                                          writer=writer,
+                                          incremental=incremental,
+                                          count=target.get('followers_count'))
 
         following = get_user_data_by_type(db, api, user_id=target['id'],
-                                          data_type='following', force=force)
+                                          data_type='following',
+                                          force=force, cached=cached,
+                                          writer=writer,
+                                          incremental=incremental,
+                                          count=target.get('friends_count'))
 
         return target, tweets, followers, following, user_lists
 
@@ -206,7 +541,11 @@ def get_user_data(db, api, name=None, uid=None, ctr=0, force=False):
         elif '88' in str(err):
             print 'Rate Limit reached on:', uid
             time.sleep(60)
-            return get_user_data(db, api, name = name, uid = uid, ctr = ctr+1)
+            return get_user_data(db, api, name = name, uid = uid, ctr = ctr+1,
+                                 force = force, cached = cached,
+                                 writer = writer, incremental = incremental,
+                                 followers_cap = followers_cap,
+                                 following_cap = following_cap)
 
         else:
             print err
@@ -214,58 +553,123 @@ def get_user_data(db, api, name=None, uid=None, ctr=0, force=False):
         return None
 
 
-def get_follower_data(db, apis, followers, force=False):
+def __to_dataframe(result):
+    '''
+    result: Nested dictionary of user id: data type: data.
+
+    return: Pandas Dataframe indexed by user id, one column per data type.
+    '''
+    try:
+        return pd.DataFrame(result).transpose()
+
+    except ValueError:
+        return pd.DataFrame().from_dict(result, orient='index')
+
+
+def get_follower_data(db, apis, followers, force=False, workers=None,
+                      batch_size=CACHE_READ_BATCH_SIZE, incremental=False):
     '''
     Get all data for all follower ids passed in followers.
 
+    Followers are downloaded concurrently by a pool of threads. Every api
+    call goes through an ApiScheduler, which sends it to the api key with
+    the most requests left for that call, so one rate limited key doesn't
+    stall the whole download.
+
     db: mongodb database object
-    apis: list of twitter API objects to be used in a round-robin fashion
-    for each download
+    apis: list of twitter API objects (or an ApiScheduler) to share between
+    downloads
     followers: list of user ids
     force: Boolean. If true will query twitter regardless of whether cache
     exists.
+    workers: Integer. Number of concurrent downloads. Defaults to the
+    number of api keys.
+    batch_size: Integer. Number of users per cache query.
+    incremental: Boolean. If true, followers with stale cached data (see
+    MAX_AGE) are updated, fetching only their new tweets.
 
     return: Pandas Dataframe containing the raw info, tweets, followers,
     following, and list returned from cache/twitter. Dataframe is indexed by
     user_id.
     '''
-    num_apis = len(apis)
+    if isinstance(apis, ApiScheduler):
+        scheduler = apis
+    else:
+        scheduler = ApiScheduler(apis)
 
-    num_followers = len(followers)
+    if workers is None:
+        workers = len(scheduler.apis)
 
-    # Begin by doing a mass-check for cached data
-    if force:
-        result = {}
-    else:
-        result = __get_cache(db, followers)
+    # Begin by doing a mass-check of which data types are cached for whom
+    # (and when they were updated), without reading the data itself.
+    complete, partial = set(), set()
+    now = time.time()
 
-    for ind, uid in enumerate(followers):
+    if not force:
+        for batch in iter_cache(db, followers, with_data=False,
+                                batch_size=batch_size):
+            for uid, record in batch.iteritems():
+                stale = incremental and any(is_stale(updated, dtype, now)
+                                            for dtype, updated
+                                            in record.iteritems())
 
-        if uid in result:
-            if len(result[uid].keys()) == 5:
-                continue
-        else:
-            result[uid] = {}
+                if len(record) == NUM_DATA_TYPES and not stale:
+                    complete.add(uid)
+                else:
+                    partial.add(uid)
 
-        print uid, ind + 1, 'of', num_followers
+    missing = [uid for uid in followers if uid not in complete]
 
-        n = ind % num_apis
+    num_missing = len(missing)
 
-        user_data = get_user_data(db, apis[n], uid=uid, force=force)
+    result = {}
 
-        if user_data is not None:
-            result[uid]['info'] = user_data[0]
-            result[uid]['tweets'] = user_data[1]
-            result[uid]['followers'] = user_data[2]
-            result[uid]['following'] = user_data[3]
-            result[uid]['list'] = user_data[4]
-        else:
-            del result[uid]
+    # Cache writes are batched into bulk upserts. Users without any cached
+    # data don't need to be looked up again one data type at a time.
+    writer = CacheWriter(db)
+
+    def fetch(uid):
+        cached = None if uid in partial else {}
+        return uid, get_user_data(db, scheduler, uid=uid, force=force,
+                                  cached=cached, writer=writer,
+                                  incremental=incremental)
+
+    pool = ThreadPool(workers)
 
-    # Dropna() will not drop fields that are empty, but not blank (e.g.
-    # someone who is not a part of any list membership will not be dropped).
     try:
-        return pd.DataFrame(result).transpose().dropna()
+        for ind, (uid, user_data) in enumerate(pool.imap_unordered(fetch,
+                                                                   missing)):
 
-    except ValueError:
-        return pd.DataFrame().from_dict(result, orient='index').dropna()
\ No newline at end of file
+            print uid, ind + 1, 'of', num_missing
+
+            if user_data is not None:
+                result[uid] = {'info': user_data[0],
+                               'tweets': user_data[1],
+                               'followers': user_data[2],
+                               'following': user_data[3],
+                               'list': user_data[4]}
+
+    finally:
+        pool.close()
+        pool.join()
+        writer.flush()
+
+    frames = [__to_dataframe(result)]
+    del result
+
+    # Only now read the complete users' data, one batch at a time. Each
+    # batch becomes its own dataframe right away, which references the
+    # cached objects instead of copying them, so the batch dictionaries
+    # never pile up.
+    complete = [uid for uid in followers if uid in complete]
+
+    for batch in iter_cache(db, complete, batch_size=batch_size):
+        frames.append(__to_dataframe(batch))
+
+    frames = [frame for frame in frames if len(frame)]
+    if not frames:
+        return pd.DataFrame()
+
+    # Dropna() will not drop fields that are empty, but not blank (e.g.
+    # someone who is not a part of any list membership will not be dropped).
+    return pd.concat(frames).sort_index().dropna()
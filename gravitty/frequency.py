@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+# Feature families whose frequencies are tracked: parsed dataframe columns
+FAMILIES = ('followers', 'following', 'list', 'mentions', 'hashtags', 'urls')
+
+FREQUENCY_INDEX = [('family', 1), ('feature', 1)]
+FREQUENCY_BATCH_SIZE = 1000
+
+# The version counter of the index, bumped whenever it changes
+FREQUENCY_STATE = {'_id': 'version'}
+
+
+def ensure_frequency_index(db):
+    '''
+    Creates the indexes of the feature frequency collections, if they do
+    not exist yet. Returns nothing.
+    '''
+    db.frequencies.ensure_index(FREQUENCY_INDEX, unique=True)
+    db.frequency_users.ensure_index('id', unique=True)
+
+
+def update_frequencies(db, df, batch_size=FREQUENCY_BATCH_SIZE):
+    '''
+    Adds the users in df to the persistent feature frequency index (and
+    bumps its version, see frequency_version, if it changed): for
+    every feature family, the number of distinct users (across every
+    account analyzed so far) that have each feature, e.g. how many users
+    mention @barackobama.
+
+    The features counted for each user are stored with it, so a user seen
+    again (e.g. following several analyzed accounts, or re-crawled) only
+    changes the counts of the features it gained or lost. Reads and writes
+    are done in batches of users.
+
+    db: Mongodb database object.
+    df: Pandas Dataframe produced by parse_dataframe (not interned).
+    batch_size: Integer. Number of users per query.
+
+    return: Integer. Number of features whose count changed.
+    '''
+
+    ensure_frequency_index(db)
+
+    users = df.index.tolist()
+    columns = {family: df[family].tolist() for family in FAMILIES}
+    changed = 0
+    written = 0
+
+    for start in xrange(0, len(users), batch_size):
+        batch = users[start:start + batch_size]
+
+        curs = db.frequency_users.find({'id': {'$in': batch}},
+                                       fields={'_id': False})
+        counted = {doc['id']: doc['features'] for doc in curs}
+        curs.close()
+
+        deltas = {}
+        user_bulk = db.frequency_users.initialize_unordered_bulk_op()
+        user_writes = 0
+
+        for row, uid in enumerate(batch, start):
+            old = counted.get(uid, {})
+            new = {}
+
+            for family in FAMILIES:
+                features = set(columns[family][row])
+                previous = set(old.get(family, ()))
+                new[family] = list(features)
+
+                for feature in features - previous:
+                    key = (family, feature)
+                    deltas[key] = deltas.get(key, 0) + 1
+
+                for feature in previous - features:
+                    key = (family, feature)
+                    deltas[key] = deltas.get(key, 0) - 1
+
+            if uid not in counted or any(set(old.get(f, ())) != set(new[f])
+                                         for f in FAMILIES):
+                user_bulk.find({'id': uid}).upsert() \
+                    .update({'$set': {'features': new}})
+                user_writes += 1
+
+        deltas = {k: v for k, v in deltas.iteritems() if v != 0}
+
+        if deltas:
+            bulk = db.frequencies.initialize_unordered_bulk_op()
+
+            for (family, feature), delta in deltas.iteritems():
+                bulk.find({'family': family, 'feature': feature}).upsert() \
+                    .update({'$inc': {'count': delta}})
+
+            bulk.execute()
+            changed += len(deltas)
+
+        if user_writes:
+            user_bulk.execute()
+            written += user_writes
+
+    if changed or written:
+        db.frequency_state.update(FREQUENCY_STATE, {'$inc': {'count': 1}},
+                                  upsert=True)
+
+    return changed
+
+
+def frequency_version(db):
+    '''
+    return: Integer. Version of the frequency index, which changes whenever
+    update_frequencies changes it (0 if it was never updated). The idf
+    weights only need to be recomputed when it changes.
+    '''
+    state = db.frequency_state.find_one(FREQUENCY_STATE)
+    return state['count'] if state else 0
+
+
+def get_frequencies(db, family, features, batch_size=FREQUENCY_BATCH_SIZE):
+    '''
+    db: Mongodb database object.
+    family: String. One of FAMILIES.
+    features: List of features.
+    batch_size: Integer. Number of features per query.
+
+    return: Numpy array of the number of users with each feature (0 if it
+    has never been counted).
+    '''
+
+    position = {feature: i for i, feature in enumerate(features)}
+    counts = np.zeros(len(features))
+
+    for start in xrange(0, len(features), batch_size):
+        batch = features[start:start + batch_size]
+        curs = db.frequencies.find({'family': family,
+                                    'feature': {'$in': batch}},
+                                   fields={'_id': False, 'feature': True,
+                                           'count': True})
+        for doc in curs:
+            counts[position[doc['feature']]] = doc['count']
+        curs.close()
+
+    return counts
+
+
+def idf_weights(db, vocabularies, batch_size=FREQUENCY_BATCH_SIZE):
+    '''
+    Inverse document frequency of every interned feature, from the
+    persistent frequency index:
+
+        idf = log((1 + N) / (1 + count)) + 1
+
+    where N is the number of users in the index. A feature every user has
+    weighs 1, a feature only one user in a million has weighs about 14.
+
+    db: Mongodb database object.
+    vocabularies: Dictionary of vocabularies from vocab.intern_dataframe.
+    batch_size: Integer. Number of features per query.
+
+    return: Dictionary of family (column): numpy array of weights, indexed
+    by the column's interned feature ids.
+    '''
+
+    total = db.frequency_users.count()
+    weights = {}
+
+    for family in FAMILIES:
+        vocab = vocabularies.get(family, vocabularies['users'])
+        counts = get_frequencies(db, family, vocab.features, batch_size)
+        weights[family] = np.log((1. + total) / (1. + counts)) + 1.
+
+    return weights
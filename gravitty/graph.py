@@ -1,39 +1,35 @@
 # -*- coding: utf-8 -*-
 import networkx as nx
+from similarity import SimilarityMatrix
 
 def make_graph(df, df_similarity=None):
     '''
     Creates an undirected graph based the users found in df. If a similarity
-    dataframe is passed, a weighted graph is returned based on these
+    dataframe/matrix is passed, a weighted graph is returned based on these
     similarities.
 
+    Weighted graphs are built in bulk from the positive entries in the upper
+    triangle of the similarity matrix; pairs scoring zero or less get no edge.
+
     df: Pandas dataframe. Must be indexed by user id.
-    df_similarity: Square dataframe with user ids as its index and columns.
-    Values should be integers or floats.
+    df_similarity: SimilarityMatrix, or square dataframe with user ids as its
+    index and columns. Values should be integers or floats.
 
     return: Undirected Networkx graph object.
     '''
 
     g = nx.Graph()
 
-    try:
-        use_weights = df_similarity == None
-
-    except:
-        use_weights = True
-
-    for i, user1_id in enumerate(df.index[:-1]):
-
-        for user2_id in df.index[i+1:]:
-
-            if use_weights:
-
-                if df_similarity.ix[user1_id, user2_id] > 0:
+    if df_similarity is None:
+        users = df.index.tolist()
+        g.add_edges_from(((user1_id, user2_id)
+                          for i, user1_id in enumerate(users[:-1])
+                          for user2_id in users[i+1:]), weight=1)
+        return g
 
-                    g.add_edge(user1_id, user2_id,
-                               weight=df_similarity.ix[user1_id, user2_id])
+    if not isinstance(df_similarity, SimilarityMatrix):
+        df_similarity = SimilarityMatrix.from_dataframe(df_similarity)
 
-            else:
-                g.add_edge(user1_id, user2_id, weight=1)
+    g.add_weighted_edges_from(df_similarity.edges())
 
-    return g
\ No newline at end of file
+    return g
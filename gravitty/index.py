@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+INDEX_FILE = '.index.json'
+CHECK_SECONDS = 1.
+
+
+def summarize(community_json):
+    '''
+    community_json: Dictionary. Community json object made by load.
+
+    return: Dictionary of the account's followers_count and the number of
+    (level 0) communities found.
+    '''
+
+    root = community_json.get('root', {})
+    nodes = community_json.get('nodes', [])
+
+    return {'followers_count': root.get('followers_count'),
+            'communities': len([n for n in nodes if n.get('group') == 0]),
+            }
+
+
+class AccountIndex(object):
+    '''
+    Index of the analyzed accounts in the cache directory, i.e. those with
+    a <screen_name>.<ext> pickle, with a summary of each: followers_count,
+    communities, analyzed (time the pickle was written) and size (bytes).
+
+    The directory is only scanned again when its modification time changes
+    (checked at most every check_seconds), and a pickle is only read when
+    it is new or was rewritten. Summaries are saved in INDEX_FILE, so other
+    processes (and later runs) don't have to read the pickles again. Safe
+    to share between threads.
+
+    path: String. Cache directory.
+    ext: String. Extension of the community json pickles.
+    check_seconds: Float.
+    '''
+
+    def __init__(self, path, ext, check_seconds=CHECK_SECONDS):
+        self.path = path
+        self.ext = ext
+        self.check_seconds = check_seconds
+        self.accounts = {}
+        self.sorted = []
+        self.mtime = None
+        self.checked = 0
+        self.lock = threading.Lock()
+
+    def __index_file(self):
+        return os.path.join(self.path, INDEX_FILE)
+
+    def __read(self):
+        try:
+            with open(self.__index_file()) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def __write(self):
+        fn = self.__index_file()
+
+        # A temporary file of our own, so concurrent writers (e.g. several
+        # app processes) never write into each other's
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fn))
+
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.accounts, f)
+
+        os.rename(tmp, fn)
+
+    def __scan(self):
+        ''' Reconciles the saved summaries with the pickles on disk. '''
+
+        saved = self.__read()
+        known = dict(saved)
+        known.update(self.accounts)
+
+        accounts = {}
+
+        for fn in os.listdir(self.path):
+            parts = fn.split('.')
+
+            if fn[0] == '.' or len(parts) != 2 or parts[1] != self.ext:
+                continue
+
+            full = os.path.join(self.path, fn)
+            if not os.path.isfile(full):
+                continue
+
+            stat = os.stat(full)
+            account = known.get(parts[0])
+
+            if account is None or account['analyzed'] != stat.st_mtime \
+                    or account['size'] != stat.st_size:
+                # A pickle that is still being written is picked up once
+                # its writer updates the index.
+                try:
+                    with open(full, 'rb') as f:
+                        account = summarize(pickle.load(f))
+                except Exception:
+                    continue
+
+                account.update(screen_name=parts[0], size=stat.st_size,
+                               analyzed=stat.st_mtime)
+
+            accounts[parts[0]] = account
+
+        self.__set(accounts)
+
+        if accounts != saved:
+            self.__write()
+
+    def __set(self, accounts):
+        self.accounts = accounts
+        self.sorted = [accounts[k] for k in sorted(accounts)]
+
+    def refresh(self, force=False):
+        ''' Rescans the cache directory if it changed. Returns nothing. '''
+
+        with self.lock:
+            now = time.time()
+
+            if not force and now - self.checked < self.check_seconds:
+                return
+
+            self.checked = now
+            mtime = os.path.getmtime(self.path)
+
+            if force or mtime != self.mtime:
+                self.__scan()
+                # Saving the index changes the directory's mtime itself
+                self.mtime = os.path.getmtime(self.path)
+
+    def update(self, screen_name, community_json):
+        '''
+        Adds (or replaces) the summary of an account whose pickle was just
+        written, without reading it back. Returns nothing.
+        '''
+
+        fn = os.path.join(self.path, '%s.%s' % (screen_name, self.ext))
+        stat = os.stat(fn)
+
+        account = summarize(community_json)
+        account.update(screen_name=screen_name, size=stat.st_size,
+                       analyzed=stat.st_mtime)
+
+        with self.lock:
+            self.accounts[screen_name] = account
+            self.__scan()
+            self.mtime = os.path.getmtime(self.path)
+
+    def available(self):
+        ''' return: Sorted list of analyzed screen names. '''
+        self.refresh()
+        return [account['screen_name'] for account in self.sorted]
+
+    def summaries(self):
+        ''' return: List of account summaries, sorted by screen name. '''
+        self.refresh()
+        return list(self.sorted)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import fcntl
+import multiprocessing
+import threading
+import time
+from main import load, cache_file, STAGES
+
+LOCK_FILE_EXT = 'lock'
+
+
+def run_job(screen_name, progress, kwargs):
+    '''
+    Runs load for screen_name in a worker process, recording the stage it
+    is in in progress (a shared dictionary). load caches the result.
+
+    The job holds a lock on <screen_name>.lock in the cache directory while
+    it runs, so that an account submitted to several app processes is only
+    analyzed once: the other jobs wait for it ('waiting' stage), then load
+    its cached result.
+
+    Pool workers are daemonic and can't start processes of their own, so
+    the similarity and louvain stages are run in the worker itself.
+    '''
+
+    def report(stage):
+        progress[screen_name] = stage
+
+    kwargs = dict(kwargs, similarity_workers=1)
+    if kwargs.get('louvain') is not None:
+        kwargs['louvain'] = dict(kwargs['louvain'], processes=1)
+
+    with open(cache_file(screen_name, LOCK_FILE_EXT), 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            report('waiting')
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+        try:
+            load(screen_name, progress=report, **kwargs)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class JobQueue(object):
+    '''
+    Analyzes accounts in the background, in a pool of worker processes, so
+    that a web request never waits on load. Each account has at most one
+    queued or running job: submitting it again returns the existing job.
+
+    processes: Integer. Number of accounts analyzed at the same time.
+    '''
+
+    def __init__(self, processes=1):
+        self.manager = multiprocessing.Manager()
+        self.progress = self.manager.dict()
+        self.pool = multiprocessing.Pool(processes)
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, screen_name, **kwargs):
+        '''
+        Queues load(screen_name, **kwargs), unless a job for screen_name is
+        already queued or running.
+
+        return: Dictionary. Status of the job (see status).
+        '''
+
+        with self.lock:
+            job = self.jobs.get(screen_name)
+
+            if job is None or job['result'].ready():
+                self.progress[screen_name] = None
+                self.jobs[screen_name] = {
+                    'submitted': time.time(),
+                    'result': self.pool.apply_async(
+                        run_job, (screen_name, self.progress, kwargs)),
+                    }
+
+        return self.status(screen_name)
+
+    def status(self, screen_name):
+        '''
+        return: Dictionary with the screen_name, status (queued, running,
+        done or failed; running also covers waiting for another process
+        analyzing the same account), current stage and its step out of steps, seconds
+        since submission, and the error message of a failed job. None if
+        the account was never submitted.
+        '''
+
+        with self.lock:
+            job = self.jobs.get(screen_name)
+
+        if job is None:
+            return None
+
+        result = job['result']
+        stage = self.progress.get(screen_name)
+        error = None
+
+        if not result.ready():
+            status = 'queued' if stage is None else 'running'
+
+        elif result.successful():
+            status = 'done'
+
+        else:
+            status = 'failed'
+            try:
+                result.get()
+            except Exception as err:
+                error = str(err) or type(err).__name__
+
+        return {'screen_name': screen_name,
+                'status': status,
+                'stage': stage,
+                'step': STAGES.index(stage) + 1 if stage in STAGES else 0,
+                'steps': len(STAGES),
+                'elapsed': time.time() - job['submitted'],
+                'error': error,
+                }
+
+    def close(self):
+        ''' Stops accepting jobs and waits for the running ones. '''
+        self.pool.close()
+        self.pool.join()
+        self.manager.shutdown()
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from similarity import score_pairs
+
+# Feature families hashed into candidate pairs: interned dataframe columns
+FAMILIES = ('followers', 'following', 'list', 'mentions', 'hashtags', 'urls')
+
+NUM_HASHES = 64
+BANDS = 32
+MAX_BUCKET = 50
+HASH_BATCH_SIZE = 16
+ROW_BLOCK_SIZE = 1 << 16
+
+# Universal hashing (a * x + b) mod PRIME of 31 bit feature ids
+PRIME = (1 << 31) - 1
+
+
+def __rows(values):
+    ''' return: Tuple of row offsets and feature ids of interned arrays. '''
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(x) for x in values])
+    ids = np.concatenate(values).astype(np.int64) if len(values) \
+        else np.zeros(0, dtype=np.int64)
+    return offsets, ids
+
+
+def minhash_signatures(values, num_hashes=NUM_HASHES, seed=0,
+                       batch_size=HASH_BATCH_SIZE, block_size=ROW_BLOCK_SIZE):
+    '''
+    MinHash signatures of sets of interned feature ids: for each of
+    num_hashes random hash functions, the smallest hash of a user's
+    features. Two users agree on a signature entry with probability equal
+    to the Jaccard similarity of their sets.
+
+    values: List of interned feature id arrays (see vocab.intern_dataframe),
+    one per user.
+    num_hashes: Integer.
+    seed: Integer. Seed of the hash functions.
+    batch_size: Integer. Number of hash functions evaluated at once.
+    block_size: Integer. Approximate number of feature ids hashed at once.
+    Users are never split across blocks, so a block holds at least one.
+
+    return: Tuple of a (users with features) x num_hashes int64 numpy array
+    of signatures and the row numbers of the users it holds. Users without
+    features have no signature.
+    '''
+
+    random = np.random.RandomState(seed)
+    a = random.randint(1, PRIME, num_hashes).astype(np.int64)
+    b = random.randint(0, PRIME, num_hashes).astype(np.int64)
+
+    offsets, ids = __rows(values)
+    users = np.flatnonzero(np.diff(offsets) > 0)
+    signatures = np.empty((len(users), num_hashes), dtype=np.int64)
+
+    if len(users) == 0:
+        return signatures, users
+
+    # Blocks of whole users, about block_size feature ids each, so only a
+    # block x batch_size array of hashes is held at a time
+    starts = offsets[users]
+    cuts = np.unique(np.concatenate([
+        np.searchsorted(starts, np.arange(0, len(ids), block_size)),
+        [len(users)]]))
+
+    for first, last in zip(cuts[:-1], cuts[1:]):
+        lo, hi = starts[first], offsets[users[last - 1] + 1]
+        block = ids[lo:hi, None]
+
+        for start in xrange(0, num_hashes, batch_size):
+            end = min(start + batch_size, num_hashes)
+            hashes = (block * a[start:end] + b[start:end]) % PRIME
+            signatures[first:last, start:end] = np.minimum.reduceat(
+                hashes, starts[first:last] - lo, axis=0)
+
+    return signatures, users
+
+
+def band_pairs(signatures, users, bands=BANDS, max_bucket=MAX_BUCKET,
+               seed=0):
+    '''
+    Locality sensitive hashing of MinHash signatures: the signature is cut
+    into bands of rows, and users whose signatures agree on every row of a
+    band share a bucket. Users with Jaccard similarity s become candidates
+    with probability 1 - (1 - s^r)^bands, where r is the number of rows per
+    band.
+
+    Buckets of more than max_bucket users (e.g. the followers of one very
+    popular account) are skipped: they would produce a quadratic number of
+    pairs sharing a single, uninformative feature.
+
+    signatures, users: As returned by minhash_signatures.
+    bands: Integer. Should divide the number of hashes.
+    max_bucket: Integer.
+    seed: Integer. Seed of the band hashes.
+
+    return: Tuple of numpy arrays of row numbers (i, j), i < j, of the
+    candidate pairs. Pairs may repeat.
+    '''
+
+    r = signatures.shape[1] // bands
+    coefficients = np.random.RandomState(seed) \
+        .randint(1, 1 << 62, r).astype(np.uint64)
+
+    found_i, found_j = [], []
+
+    for band in xrange(bands):
+        block = signatures[:, band * r:(band + 1) * r].astype(np.uint64)
+        keys = (block * coefficients).sum(axis=1)
+
+        order = np.argsort(keys, kind='mergesort')
+        keys = keys[order]
+        members = users[order]
+
+        # Bucket number and size of every member, in sorted order
+        starts = np.concatenate([[True], keys[1:] != keys[:-1]])
+        bucket = np.cumsum(starts) - 1
+        sizes = np.bincount(bucket)[bucket]
+
+        small = (sizes > 1) & (sizes <= max_bucket)
+        bucket, members = bucket[small], members[small]
+
+        for d in xrange(1, min(max_bucket, len(members))):
+            same = bucket[:-d] == bucket[d:]
+            if not same.any():
+                break
+            found_i.append(members[:-d][same])
+            found_j.append(members[d:][same])
+
+    if not found_i:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty
+
+    i, j = np.concatenate(found_i), np.concatenate(found_j)
+    return np.minimum(i, j), np.maximum(i, j)
+
+
+def candidate_pairs(df, num_hashes=NUM_HASHES, bands=BANDS,
+                    max_bucket=MAX_BUCKET, seed=0):
+    '''
+    Pairs of users likely to have a positive similarity score: those that
+    follow or mention each other, plus those that LSH finds similar (by
+    Jaccard similarity) in at least one feature family.
+
+    The account followed by everyone (the analyzed account) is left out of
+    the following sets, as in similarity_components.
+
+    df: Pandas Dataframe interned by vocab.intern_dataframe.
+    num_hashes, bands, max_bucket, seed: See minhash_signatures and
+    band_pairs.
+
+    return: Tuple of numpy arrays of row numbers (i, j), i < j, of distinct
+    candidate pairs.
+    '''
+
+    n = df.shape[0]
+    found_i, found_j = [], []
+
+    # Direct relationships are cheap to list exactly
+    for column in ('followers', 'following', 'mentions'):
+        offsets, ids = __rows(df[column].tolist())
+        rows = np.repeat(np.arange(n), np.diff(offsets))
+        inside = (ids < n) & (ids != rows)
+        found_i.append(np.minimum(rows, ids)[inside])
+        found_j.append(np.maximum(rows, ids)[inside])
+
+    for column in FAMILIES:
+        values = df[column].tolist()
+
+        if column == 'following':
+            offsets, ids = __rows(values)
+            if len(ids):
+                top = np.bincount(ids).argmax()
+                values = [x[x != top] for x in values]
+
+        signatures, users = minhash_signatures(values, num_hashes, seed)
+        i, j = band_pairs(signatures, users, bands, max_bucket, seed)
+        found_i.append(i)
+        found_j.append(j)
+
+    keys = np.unique(np.concatenate(found_i) * n + np.concatenate(found_j))
+
+    return keys // n, keys % n
+
+
+def make_approximate_similarity(df, weights=None, num_hashes=NUM_HASHES,
+                                bands=BANDS, max_bucket=MAX_BUCKET, seed=0):
+    '''
+    Approximate make_similarity_matrix for very large sets of users: only
+    the candidate pairs found by candidate_pairs are scored (exactly, see
+    similarity.score_pairs). Pairs that are not candidates score as if
+    they shared nothing, so the approximation can only miss edges, mostly
+    weak ones, never add them.
+
+    df: Pandas Dataframe interned by vocab.intern_dataframe.
+    weights: Dictionary of per feature weights, see similarity_components.
+    Optional.
+    num_hashes, bands, max_bucket, seed: See candidate_pairs.
+
+    return: SimilarityMatrix indexed by df.index.
+    '''
+
+    rows, cols = candidate_pairs(df, num_hashes, bands, max_bucket, seed)
+    return score_pairs(df, rows, cols, weights)
+
+
+def compare_edges(exact, approximate, min_score=0.):
+    '''
+    Recall and precision of the edges of an approximate SimilarityMatrix
+    against the exact one. Recall can be restricted to the stronger exact
+    edges, those scoring at least min_score.
+
+    return: Dictionary of edges (exact count), recall (fraction of exact
+    edges found), weighted_recall (fraction of the exact edge weight found)
+    and precision (fraction of approximate edges that are exact edges, with
+    the same score).
+    '''
+
+    truth = {(u, v): w for u, v, w in exact.edges()}
+    found = approximate.edges()
+
+    correct = [(u, v) for u, v, w in found
+               if abs(truth.get((u, v), 0.) - w) <= 1e-9 * abs(w)]
+
+    strong = {k: w for k, w in truth.iteritems() if w >= min_score}
+    hits = [strong[k] for k in correct if k in strong]
+    total = sum(strong.itervalues())
+
+    return {'edges': len(strong),
+            'recall': len(hits) / float(len(strong)) if strong else 1.,
+            'weighted_recall': sum(hits) / total if total else 1.,
+            'precision': len(correct) / float(len(found)) if found else 1.,
+            }
@@ -1,11 +1,23 @@
 # -*- coding: utf-8 -*-
 import pymongo, pickle, os
 from utils import oauth_login
-from data import get_user_data, get_follower_data
+from data import (get_user_data, get_follower_data, ensure_cache_index,
+                  FOLLOWERS_CAP, FOLLOWING_CAP)
 from parse import filter_dataframe, parse_dataframe
-from similarity import make_similarity_dataframe
+from columnar import write_raw
+from stages import StageCache, stage_key
+from index import AccountIndex
+from serialize import write_json
+from vocab import intern_dataframe
+from frequency import update_frequencies, idf_weights, frequency_version
+from similarity import (make_similarity_matrix, make_similarity_dataframe,
+                        weight_constants)
+from lsh import make_approximate_similarity
+from sparsify import (sparsify_similarity, sparsification_report,
+                      sparsification_summary)
 from graph import make_graph
-from community import generate_dendrogram
+from community import (generate_dendrogram, generate_dendrograms, most_stable,
+                       complete_partition, best_partition, partition_at_level)
 from community_analytics import (get_community_assignment,
                                  get_community_analytics,
                                  create_community_graph,
@@ -16,10 +28,22 @@ API_PATH = 'api_keys/'
 PKL_PATH = 'cache/'
 PKL_FILE_EXT = 'pkl'
 DBG_FILE_EXIT = 'pkl_debug'
+JSON_FILE_EXT = 'json'
+RAW_DIR_EXT = 'raw'
+STAGE_DIR_EXT = 'stages'
+STAGES = ('fetch', 'parse', 'similarity', 'graph', 'louvain', 'analytics',
+          'names', 'json')
 DB_NAME = 'twitter'
 
+__ACCOUNT_INDEX = None
+
 def load(screen_name=None, user_id=None, force_db_update = False,
-                  force_twitter_update=False, debug=False):
+                  force_twitter_update=False, debug=False,
+                  dense_similarity=False, sparsify=None, louvain=None,
+                  refresh=False, update_twitter=False,
+                  followers_cap=FOLLOWERS_CAP, following_cap=FOLLOWING_CAP,
+                  progress=None, idf=False, approximate=None,
+                  similarity_workers=1):
     '''
     Main entry point into gravitty module. Should be used by importing
     gravitty and calling gravitty.load('<your_screen_name').
@@ -41,8 +65,29 @@ def load(screen_name=None, user_id=None, force_db_update = False,
 
     Also, by default, this app will create two pickled objects,
     one containing the debug data described above, the other containing the
-    community json file. Subsequent calls for the same user will use this
-    data to save time (and api calls).
+    community json file (which is also saved serialized, as
+    <screen_name>.json and .json.gz, for the web app to serve). Subsequent
+    calls for the same user will use this data to save time (and api
+    calls). The raw twitter data is not pickled:
+    it is written in a columnar format to a '<screen_name>.raw' directory
+    and the debug data holds a columnar.RawStore for it (use its dataframe
+    method to load some or all of its columns).
+
+    Each stage of the analysis (fetching, parsing, similarity, graph,
+    community detection, analytics and screen names) saves its result in a
+    '<screen_name>.stages' directory as soon as it completes, keyed by a
+    hash of its inputs and parameters. If a run fails, the next one picks
+    up after the last completed stage. Changing a parameter only reruns the
+    stages from the one it affects onwards, and the force/update flags
+    below refetch the data but only rerun later stages if it changed.
+    Every parsed follower is added to a persistent index of how many users
+    have each feature (mention, hashtag, url, ...) across every analyzed
+    account. With idf = True, shared features are weighted by their
+    inverse frequency in that index (see frequency.idf_weights), so sharing
+    a rare hashtag counts for more than both mentioning @barackobama.
+
+    progress, if given, is called with the name of each stage (see STAGES)
+    as it starts.
 
     To override the use of pickled data, use force_db_update = True. Data
     for each follower will be pulled from mongoDB if possible, otherwise it
@@ -51,109 +96,322 @@ def load(screen_name=None, user_id=None, force_db_update = False,
     To do a clean-slate download, downloading everything from twitter,
     use force_twitter_update = True.
 
+    To bring cached twitter data up to date without downloading everything
+    again, use update_twitter = True. Cached data older than data.MAX_AGE
+    is refetched, and stale timelines only fetch tweets newer than the ones
+    already cached. The pickled data is ignored.
+
+    By default, accounts with more than FOLLOWERS_CAP followers (or
+    FOLLOWING_CAP friends) are refused. Raise followers_cap/following_cap
+    (or pass None) to analyze larger accounts. Their followers are fetched
+    5k ids at a time, and an interrupted download resumes where it stopped.
+
+    User similarity is kept as a sparse SimilarityMatrix. For small
+    accounts, dense_similarity = True stores it as a square dataframe
+    instead, which is easier to inspect in the debug output.
+
+    For accounts too large to score every pair of followers, pass a
+    dictionary of options for lsh.make_approximate_similarity (possibly
+    empty, e.g. approximate = {'num_hashes': 128, 'bands': 64}) to only
+    score pairs that MinHash/LSH finds similar in some feature family.
+    This misses some (mostly weak) edges, see lsh.compare_edges.
+    Otherwise, similarity_workers > 1 (or None, one per cpu) splits the
+    sparse products of the similarity across that many processes, see
+    similarity_components. The rest of the stage stays serial.
+    Approximate similarity doesn't support it.
+
+    To speed up community detection on large accounts, weak edges can be
+    pruned from the similarity graph by passing a dictionary of options
+    for sparsify_similarity, e.g. sparsify = {'top_k': 20}. What this
+    costs is stored in the community graph's 'sparsification' attribute
+    (and so in the community json's graph attributes): by default the
+    edges and weight kept and the modularity on the full similarity (see
+    sparsify.sparsification_summary). Adding 'report': True to the options
+    also runs the louvain method on the full graph for the modularity lost
+    (see sparsify.sparsification_report), which is slower than not
+    sparsifying at all, so only use it for tuning.
+
+    Several candidate community partitions can be computed in parallel by
+    passing a dictionary of options for community.generate_dendrograms,
+    e.g. louvain = {'resolutions': [0.5, 1., 2.], 'seeds': [None, 1, 2]}.
+    The most stable candidate is used.
+
+    To refresh an account that has already been analyzed, use refresh =
+    True. Like force_db_update, the pickled data is ignored, but community
+    detection starts from the level-0 communities of the previous run (new
+    followers join their most similar neighbor's community), so it
+    converges in far fewer passes.
+
     '''
 
     if screen_name == None and user_id == None:
         raise Exception('Please enter an id or name')
 
+    if approximate is not None and similarity_workers != 1:
+        raise ValueError('similarity_workers is not supported with '
+                         'approximate similarity')
+
+    ABS_PKL_PATH = os.path.join(os.path.dirname(__file__), PKL_PATH)
+
     # Assume that if screen_name was not provided (only user id) then a
     # pickle has not been created.
     if screen_name is not None:
-        ABS_PKL_PATH = os.path.join(os.path.dirname(__file__), PKL_PATH)
         sn_file = ABS_PKL_PATH + str(screen_name) + '.' + PKL_FILE_EXT
         sn_file_debug = ABS_PKL_PATH + str(screen_name) + '.' + DBG_FILE_EXIT
 
         # Check to see if there are pickles for the user. Note that this will
         # be overriden if force_db_update is set to true
-        if os.path.isfile(sn_file_debug) and debug \
-                and not force_twitter_update and not force_db_update:
-            return pickle.load(open(sn_file_debug, 'rb'))
-
-        if os.path.isfile(sn_file) \
-                and not force_twitter_update and not force_db_update:
-            return pickle.load(open(sn_file, 'rb'))
-
-    # Use api credentials from files located in the API_PATH.
-    ABS_API_PATH = os.path.join(os.path.dirname(__file__), API_PATH)
-    apis = oauth_login(ABS_API_PATH)
-
-    # Try to start up a mongo database connection to cache data in
-    try:
-        conn = pymongo.MongoClient("localhost", 27017)
-
-    except pymongo.errors.ConnectionFailure:
-        print 'Please run mongod and re-run program'
-        raise Exception('DBError')
-
-    db = conn[DB_NAME]
-
-    # Get the target user's data from either the screen_name or user_id
-    user_data = get_user_data(db, apis[0],
-                              name = screen_name, uid = user_id,
-                              force = force_twitter_update)
-
-    # If the user is protected (or has more than the maximum
-    # followers/friends), then return an error
-    if user_data == None:
-        print 'Was unable to access data for %s / %s' % (screen_name, user_id)
-        raise Exception('TargetError')
-
+        if os.path.isfile(sn_file_debug) and debug and not refresh \
+                and not force_twitter_update and not force_db_update \
+                and not update_twitter:
+            with open(sn_file_debug, 'rb') as f:
+                return pickle.load(f)
+
+        if os.path.isfile(sn_file) and not refresh \
+                and not force_twitter_update and not force_db_update \
+                and not update_twitter:
+            with open(sn_file, 'rb') as f:
+                return pickle.load(f)
+
+    # The result of each stage below is saved as it completes, keyed by a
+    # hash of its inputs and parameters, so a failed or repeated run picks
+    # up from the last stage whose inputs haven't changed.
+    stages = StageCache(ABS_PKL_PATH + str(screen_name or user_id) +
+                        '.' + STAGE_DIR_EXT)
+
+    def report(stage):
+        if progress is not None:
+            progress(stage)
+
+    # Twitter and mongo are only connected to if a stage needs them.
+    connection = {}
+
+    def connect_db():
+        if 'db' not in connection:
+            connection['conn'], connection['db'] = __connect_db()
+        return connection['db']
+
+    def connect():
+        if 'apis' not in connection:
+            connection['apis'] = __login()
+        return connection['apis'], connect_db()
+
+    # Any of the update flags means the data has to be fetched again.
+    # Stages after it are only rerun if the data actually changed.
+    report('fetch')
+    fetch_key = stage_key(screen_name, user_id, followers_cap, following_cap)
+    fetch = None
+
+    if not (refresh or force_twitter_update or force_db_update or
+            update_twitter):
+        fetch = stages.load('fetch', fetch_key)
+
+    if fetch is None:
+        apis, db = connect()
+
+        # Get the target user's data from either the screen_name or user_id
+        user_data = get_user_data(db, apis[0],
+                                  name = screen_name, uid = user_id,
+                                  force = force_twitter_update,
+                                  incremental = update_twitter,
+                                  followers_cap = followers_cap,
+                                  following_cap = following_cap)
+
+        # If the user is protected (or has more than the maximum
+        # followers/friends), then return an error
+        if user_data == None:
+            print 'Was unable to access data for %s / %s' % (screen_name,
+                                                             user_id)
+            raise Exception('TargetError')
+
+        followers = user_data[2]
+
+        # Using the target user's list of followers (user ids), get the same
+        # information we just got for the target user for each of its
+        # followers
+        raw_df = get_follower_data(db, apis, followers,
+                                   force = force_twitter_update,
+                                   incremental = update_twitter)
+
+        # Store the raw data in a compact, memory mappable columnar format
+        # instead of pickling it with the debug data.
+        raw = write_raw(raw_df, ABS_PKL_PATH +
+                        str(screen_name or user_data[0]['screen_name']) +
+                        '.' + RAW_DIR_EXT)
+
+        fetch = (user_data, raw)
+        stages.save('fetch', fetch_key, fetch)
+
+    user_data, raw = fetch
     user_info, user_tweets, followers, following, user_lists = user_data
 
-    # Using the target user's list of followers (user ids), get the same
-    # information we just got for the target user for each of its followers
-    raw_df = get_follower_data(db, apis, followers,
-                               force = force_twitter_update)
-
     # Filter the dataframe for inactive users. Then parse the raw dataframe
     # to extract the relevant features from the raw data
-    df = parse_dataframe( filter_dataframe(raw_df) )
+    report('parse')
+    parse_key = stage_key(raw.digest())
+    df = stages.load('parse', parse_key)
+
+    if df is None:
+        df = parse_dataframe( filter_dataframe(raw.dataframe()) )
+
+        # Count the new followers' features in the frequency index before
+        # the stage is saved, so a failed update is retried by the next run
+        update_frequencies(connect_db(), df)
+        stages.save('parse', parse_key, df)
 
     # With the features in hand, calculate the latent similarity between each
     # set of users. See similarity.py for more detail on the calculations of
     # this similarity metric.
 
-    # The resulting dataframe will be a square matrix indexed/columned by
-    # user_id and contain the undirected edge weights between each pair of
-    # users.
-    df_similarity = make_similarity_dataframe(df)
+    # The result is a sparse, symmetric matrix of the undirected edge
+    # weights between each pair of users, with a user_id <-> row index.
+    # Optionally, a dense square dataframe indexed/columned by user_id.
+    # Features are interned as sorted integer arrays first, which are much
+    # smaller than sets and turn straight into sparse matrices.
+    # With idf, the weights depend on the frequency index, so the stage is
+    # rerun whenever it changes, as it is when the scoring weights change.
+    report('similarity')
+    similarity_key = stage_key(parse_key, dense_similarity, idf,
+                               idf and frequency_version(connect_db()),
+                               approximate, weight_constants())
+    df_similarity = stages.load('similarity', similarity_key)
+
+    if df_similarity is None:
+        df_interned, vocabularies = intern_dataframe(df)
+
+        weights = None
+        if idf:
+            weights = idf_weights(connect_db(), vocabularies)
+
+        if approximate is not None:
+            df_similarity = make_approximate_similarity(df_interned, weights,
+                                                        **approximate)
+            if dense_similarity:
+                df_similarity = df_similarity.to_dataframe()
+        elif dense_similarity:
+            df_similarity = make_similarity_dataframe(
+                df_interned, weights=weights, workers=similarity_workers)
+        else:
+            df_similarity = make_similarity_matrix(df_interned, weights,
+                                                   similarity_workers)
+        stages.save('similarity', similarity_key, df_similarity)
+
+    # Optionally prune weak edges so the louvain method doesn't run on a
+    # nearly complete graph. The full similarity is kept for debugging.
 
     # Make an undirected representing the relationship between each user,
     # if any. Each node ID is the user ID, each edge weight is equal to the
     # similarity score between those two users.
-    graph = make_graph(df, df_similarity)
+    report('graph')
+    full_report = False
+    if sparsify is not None:
+        sparsify = dict(sparsify)
+        full_report = sparsify.pop('report', False)
+
+    graph_key = stage_key(similarity_key, sparsify)
+    graph = stages.load('graph', graph_key)
+
+    if graph is None:
+        if sparsify is not None:
+            graph_similarity = sparsify_similarity(df_similarity, **sparsify)
+        else:
+            graph_similarity = df_similarity
+
+        graph = make_graph(df, graph_similarity)
+        stages.save('graph', graph_key, graph)
+
+    # When refreshing, seed community detection with the previous run's
+    # level-0 communities, if there was one.
+    part_init = None
+    if refresh:
+        part_init = __previous_partition(stages)
+        if part_init is not None:
+            part_init = complete_partition(part_init, graph, 'neighbor')
 
     # Using the louvain method, find communities within the weighted graph.
     # The returned dendrogram is a list of dictionaries where the values of
     # each dictionary are the keys of the next dictionary. The length of the
     # dendrogram indicates the number of levels of community clusters
-    # detected.
-    dendrogram = generate_dendrogram(graph)
-
-    # Add a final mapping to the dendrogram that maps everyone into the
-    # same community. They are, after all, followers of the same user.
-    dendrogram.append({k:0 for k in dendrogram[-1].values()})
-
-    # Modify the dataframe to contain columns titled 'cid + <level>'. Each
-    # column contains the community id's for that level for each user.
-    # Also, this is a convenient time to calculate graph modularity at each
-    # level so produce that here as well.
-    df, modularity = get_community_assignment(df, graph, dendrogram)
-
-    num_levels = len(dendrogram)
-
-    # For each community at each level of the dendrogram, find the topics,
-    # sentiment, biggest influencers, etc. for each.
-    data = get_community_analytics(df, graph, num_levels,
-                                   community_modularity = modularity)
+    # detected. The array engine runs on CSR arrays rather than networkx
+    # dicts, which is much faster on dense similarity graphs.
+    report('louvain')
+    louvain_key = stage_key(graph_key, louvain, part_init and
+                            sorted(part_init.items()))
+    dendrogram = stages.load('louvain', louvain_key)
+
+    if dendrogram is None:
+        if louvain is not None:
+            dendrogram = most_stable(generate_dendrograms(
+                graph, part_init=part_init, **louvain))['dendrogram']
+        else:
+            dendrogram = generate_dendrogram(graph, part_init,
+                                             engine='array')
+
+        # Add a final mapping to the dendrogram that maps everyone into the
+        # same community. They are, after all, followers of the same user.
+        dendrogram.append({k:0 for k in dendrogram[-1].values()})
+
+        stages.save('louvain', louvain_key, dendrogram)
+
+    report('analytics')
+    analytics_key = stage_key(louvain_key, full_report)
+    analytics = stages.load('analytics', analytics_key)
+
+    if analytics is None:
+        # Measure what sparsifying cost: the edges kept, and the modularity
+        # on the full similarity. Only the full report compares it to the
+        # full graph's own communities.
+        sparsification = None
+        if sparsify is not None:
+            partition = partition_at_level(dendrogram, len(dendrogram) - 2)
+            if full_report:
+                full_graph = make_graph(df, df_similarity)
+                sparsification = sparsification_report(
+                    full_graph, graph, partition,
+                    best_partition(full_graph, engine='array'))
+                del full_graph
+            else:
+                sparsification = sparsification_summary(df_similarity,
+                                                        graph, partition)
+
+        # Modify the dataframe to contain columns titled 'cid + <level>'.
+        # Each column contains the community id's for that level for each
+        # user. Also, this is a convenient time to calculate graph modularity
+        # at each level so produce that here as well.
+        df, modularity = get_community_assignment(df, graph, dendrogram)
+
+        num_levels = len(dendrogram)
+
+        # For each community at each level of the dendrogram, find the
+        # topics, sentiment, biggest influencers, etc. for each.
+        data = get_community_analytics(df, graph, num_levels,
+                                       community_modularity = modularity)
+
+        analytics = (df, data, sparsification)
+        stages.save('analytics', analytics_key, analytics)
+
+    df, data, sparsification = analytics
 
     # Both the mentioned and most connected users fields from the community
     # analytics function are user ids. Turn them into screen names.
-    data = get_screen_names(data, 'mentioned', df, db, apis[0])
-    data = get_screen_names(data, 'most_connected', df, db, apis[0])
+    report('names')
+    names_key = stage_key(analytics_key)
+    named_data = stages.load('names', names_key)
+
+    if named_data is None:
+        apis, db = connect()
+        named_data = get_screen_names(data, 'mentioned', df, db, apis[0])
+        named_data = get_screen_names(named_data, 'most_connected', df, db,
+                                      apis[0])
+        stages.save('names', names_key, named_data)
+
+    data = named_data
 
     # Close the database connection. It is no longer needed.
-    conn.close()
+    if 'conn' in connection:
+        connection['conn'].close()
+
+    report('json')
 
     # Create a networkx graph where each node represents a community. Edges
     # represent membership into larger communities at the next level up (
@@ -162,6 +420,9 @@ def load(screen_name=None, user_id=None, force_db_update = False,
     # attributes of each node.
     community_graph = create_community_graph(data, dendrogram)
 
+    if sparsification is not None:
+        community_graph.graph['sparsification'] = sparsification
+
     # Parse this graph into a json representation for use & consumption by
     # d3.js
     community_json = create_community_json(community_graph, user_info)
@@ -171,38 +432,130 @@ def load(screen_name=None, user_id=None, force_db_update = False,
         screen_name = user_info['screen_name']
 
     # Pickle the objects for reuse.
-    ABS_PKL_PATH = os.path.join(os.path.dirname(__file__), PKL_PATH)
     sn_file = ABS_PKL_PATH + str(screen_name) + '.' + PKL_FILE_EXT
     sn_file_debug = ABS_PKL_PATH + str(screen_name) + '.' + DBG_FILE_EXIT
 
-    pickle.dump((raw_df, df, df_similarity, dendrogram, data,
-                 community_graph, community_json), open(sn_file_debug, 'wb'))
+    with open(sn_file_debug, 'wb') as f:
+        pickle.dump((raw, df, df_similarity, dendrogram, data,
+                     community_graph, community_json), f)
+
+    with open(sn_file, 'wb') as f:
+        pickle.dump(community_json, f)
 
-    pickle.dump(community_json, open(sn_file, 'wb'))
+    # Also write the community json serialized (and gzipped), ready to be
+    # served as is.
+    write_json(community_json, cache_file(screen_name, JSON_FILE_EXT))
+
+    account_index().update(screen_name, community_json)
 
     # If debug is true, return all of the precusor objects along with the json
     if debug:
-        return (raw_df, df, df_similarity, dendrogram, data,
+        return (raw, df, df_similarity, dendrogram, data,
                 community_graph, community_json)
 
     # Otherwise return the json object
     return community_json
 
 
+def __login():
+    '''
+    Logs in to twitter.
+
+    return: List of twitter api objects.
+    '''
+
+    # Use api credentials from files located in the API_PATH.
+    ABS_API_PATH = os.path.join(os.path.dirname(__file__), API_PATH)
+    return oauth_login(ABS_API_PATH)
+
+
+def __connect_db():
+    '''
+    Connects to the mongo cache.
+
+    return: Tuple of the mongo connection and the mongo database object.
+    '''
+
+    # Try to start up a mongo database connection to cache data in
+    try:
+        conn = pymongo.MongoClient("localhost", 27017)
+
+    except pymongo.errors.ConnectionFailure:
+        print 'Please run mongod and re-run program'
+        raise Exception('DBError')
+
+    db = conn[DB_NAME]
+
+    # Every cache lookup is by (id, type), make sure that is indexed
+    ensure_cache_index(db)
+
+    return conn, db
+
+
+def __previous_partition(stages):
+    '''
+    Finds the level-0 community partition of a previous run in the louvain
+    stage artifact, which only holds the dendrogram, rather than in the
+    (much larger) debug pickle.
+
+    stages: StageCache of the account.
+
+    return: Dictionary of user_id: community_id, or None if the account has
+    not been analyzed before.
+    '''
+
+    dendrogram = stages.latest('louvain')
+
+    if dendrogram is None:
+        return None
+
+    return dendrogram[0]
+
+
+def cache_file(screen_name, ext=PKL_FILE_EXT):
+    '''
+    return: String. Path of the pickled community json (or the debug data,
+    with ext=DBG_FILE_EXIT) of screen_name in the cache directory.
+    '''
+    ABS_PKL_PATH = os.path.join(os.path.dirname(__file__), PKL_PATH)
+    return ABS_PKL_PATH + str(screen_name) + '.' + ext
+
+
+def account_index():
+    '''
+    return: The AccountIndex of the cache directory, shared by available
+    and account_summaries.
+    '''
+    global __ACCOUNT_INDEX
+
+    if __ACCOUNT_INDEX is None:
+        ABS_PKL_PATH = os.path.join(os.path.dirname(__file__), PKL_PATH)
+        __ACCOUNT_INDEX = AccountIndex(ABS_PKL_PATH, PKL_FILE_EXT)
+
+    return __ACCOUNT_INDEX
+
+
 def available():
     '''
     Find all users that have been previously analyzed and whose community
     graphs are available for display. All other requests to load() will
     require processing.
 
-    return: List of all users' screen names if a non-debug pickled object
-    is found in the cache directory.
+    The cache directory is indexed (see index.AccountIndex) and only
+    scanned again when it changes.
+
+    return: Sorted list of all users' screen names if a non-debug pickled
+    object is found in the cache directory.
     '''
 
-    ABS_PKL_PATH = os.path.join(os.path.dirname(__file__), PKL_PATH)
+    return account_index().available()
+
 
-    files_exts = [f.split('.') for f in os.listdir(ABS_PKL_PATH)
-                  if os.path.isfile(os.path.join(ABS_PKL_PATH,f))
-                     and f[0] != '.']
+def account_summaries():
+    '''
+    return: List of dictionaries, one per available user sorted by screen
+    name, with its screen_name, followers_count, number of communities,
+    analysis time (analyzed) and pickle size in bytes.
+    '''
 
-    return [f[0] for f in files_exts if f[1] == PKL_FILE_EXT]
\ No newline at end of file
+    return account_index().summaries()
@@ -2,6 +2,8 @@
 import pandas as pd
 import re
 
+HASHTAG_WORD = re.compile('[a-z]')
+
 # Source: http://stackoverflow.com/posts/6027703/revisions
 def __flatten(d, lkey=''):
     ''' Flattens nested dictionaries. Resulting dictionary has flattened
@@ -80,6 +82,82 @@ def __parse_user_tweets(tweets, src='', sub=None, sub_cond=None, cond=None):
     return result
 
 
+def __clean_hashtag(hashtag):
+    '''
+    Drops non-ascii characters and lowercases a hashtag, the same as
+    __parse_user_tweets does character by character.
+    '''
+    if isinstance(hashtag, unicode):
+        return hashtag.encode('ascii', 'ignore').lower()
+    return hashtag.decode('ascii', 'ignore').encode('ascii').lower()
+
+
+def __lookup(d, key):
+    '''
+    Returns d[key] as if d had been flattened (see __flatten), without
+    flattening it: e.g. user_mentions is also looked for in
+    d['user']['mentions']. Returns None if key is not found.
+    '''
+    if key in d:
+        return d[key]
+
+    # Only keys with underscores can come from nested dictionaries
+    if '_' not in key:
+        return None
+
+    for k, v in d.iteritems():
+        if isinstance(v, dict) and key.startswith(k + '_'):
+            found = __lookup(v, key[len(k) + 1:])
+            if found is not None:
+                return found
+
+    return None
+
+
+def __parse_timeline(tweets):
+    '''
+    Parse each user's list of tweet objects in a single pass, extracting
+    everything __parse_user_tweets does in four. Fields are read from the
+    top level of each tweet and only looked for in nested dictionaries when
+    missing, rather than flattening every tweet.
+
+    tweets: List of tweets
+
+    return: Tuple of sets of english tweet texts, mentioned user ids,
+    (cleaned) hashtags and urls. Tuple of empty lists if tweets is not a
+    list.
+    '''
+
+    if not type(tweets) == list:
+        return [], [], [], []
+
+    texts, mentions, hashtags, urls = set(), set(), set(), set()
+
+    for tweet in tweets:
+
+        text = __lookup(tweet, 'text')
+        if text is not None and tweet.get('lang') == 'en':
+            if type(text) == list:
+                texts.update(text)
+            else:
+                texts.add(text)
+
+        for mention in __lookup(tweet, 'user_mentions') or ():
+            mentions.add(mention['id'])
+
+        tags = __lookup(tweet, 'hashtags')
+        if type(tags) == list:
+            for hashtag in tags:
+                hashtag = __clean_hashtag(hashtag)
+                if HASHTAG_WORD.search(hashtag):
+                    hashtags.add(hashtag)
+
+        for url in __lookup(tweet, 'urls') or ():
+            urls.add(url[0])
+
+    return texts, mentions, hashtags, urls
+
+
 def __parse_user_info(info, src=''):
     ''' Returns source field from info dictionary '''
     if src in info:
@@ -104,11 +182,13 @@ def __parse_user_lists(user_list):
     return set([ul['id'] for ul in user_list])
 
 
-def parse_dataframe(in_df):
+def parse_dataframe(in_df, single_pass=True):
     '''
     Extracts key pieces of data from raw user dataframe.
 
     in_df: Raw user dataframe from cache/twitter.
+    single_pass: Boolean. If true, each user's tweets are parsed in one pass
+    (see __parse_timeline), otherwise once per extracted field.
 
     return: Cleaned dataframe ready to have scored for pair-wise user
     similarity
@@ -126,17 +206,27 @@ def parse_dataframe(in_df):
     df['location'] = in_df['info'].apply(__parse_user_info,
                                          src='location')
 
-    df['tweets'] = in_df['tweets'].apply(__parse_user_tweets,
-                                         src='text',sub_cond='lang',cond='en')
+    if single_pass:
+        timelines = zip(*[__parse_timeline(tweets)
+                          for tweets in in_df['tweets']]) or [[]] * 4
+
+        for column, values in zip(('tweets', 'mentions', 'hashtags', 'urls'),
+                                  timelines):
+            df[column] = pd.Series(list(values), index=in_df.index)
+
+    else:
+        df['tweets'] = in_df['tweets'].apply(__parse_user_tweets,
+                                             src='text', sub_cond='lang',
+                                             cond='en')
 
-    df['mentions'] = in_df['tweets'].apply(__parse_user_tweets,
-                                           src='user_mentions', sub='id')
+        df['mentions'] = in_df['tweets'].apply(__parse_user_tweets,
+                                               src='user_mentions', sub='id')
 
-    df['hashtags'] = in_df['tweets'].apply(__parse_user_tweets,
-                                           src='hashtags')
+        df['hashtags'] = in_df['tweets'].apply(__parse_user_tweets,
+                                               src='hashtags')
 
-    df['urls'] = in_df['tweets'].apply(__parse_user_tweets,
-                                       src='urls', sub=0)
+        df['urls'] = in_df['tweets'].apply(__parse_user_tweets,
+                                           src='urls', sub=0)
 
     df['followers'] = in_df['followers'].apply(__parse_user_followers)
 
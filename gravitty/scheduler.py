@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import twitter
+
+# Requests per key per rate limit window, by twitter api method. See
+# https://dev.twitter.com/docs/rate-limiting/1.1/limits
+RATE_LIMITS = {'GetListsList': 15,
+               'GetFriendIDs': 15,
+               'GetFollowerIDs': 15,
+               'GetUserTimeline': 180,
+               'GetUser': 180,
+               }
+
+RATE_WINDOW = 15 * 60
+
+# Resource family and endpoint of each method in GetRateLimitStatus
+RATE_RESOURCES = {'GetListsList': ('lists', '/lists/list'),
+                  'GetFriendIDs': ('friends', '/friends/ids'),
+                  'GetFollowerIDs': ('followers', '/followers/ids'),
+                  'GetUserTimeline': ('statuses', '/statuses/user_timeline'),
+                  'GetUser': ('users', '/users/show/:id'),
+                  }
+
+
+class ApiScheduler(object):
+    '''
+    Routes twitter api calls across several api keys. The scheduler keeps
+    track of the remaining requests and the reset time of every key for
+    every rate limited method, and sends each call to the key with the most
+    requests left. Calls only block when every key is exhausted for that
+    method, until the earliest reset.
+
+    Unless seed is False, every key's remaining requests and reset times
+    are first read from twitter (GetRateLimitStatus), so keys that were
+    already partly used, e.g. before a restart, aren't counted as full.
+
+    The scheduler can be used in place of a twitter.Api object (e.g.
+    scheduler.GetUser(user_id=...)) and is safe to share between threads.
+
+    apis: List of twitter api objects (or a single one). Any object with the
+    methods in limits will do, e.g. a local fake of the twitter api.
+    limits: Dictionary of api method name: requests per window.
+    window: Length of a rate limit window in seconds.
+    clock: Function returning the current time in seconds.
+    sleep: Function used to wait for a rate limit reset.
+    seed: Boolean.
+    '''
+
+    def __init__(self, apis, limits=RATE_LIMITS, window=RATE_WINDOW,
+                 clock=time.time, sleep=time.sleep, seed=True):
+
+        self.apis = apis if isinstance(apis, list) else [apis]
+        self.limits = limits
+        self.window = window
+        self.clock = clock
+        self.sleep = sleep
+
+        self.remaining = {m: [n] * len(self.apis) for m, n in limits.items()}
+        self.reset = {m: [None] * len(self.apis) for m in limits}
+        self.lock = threading.Lock()
+
+        if seed:
+            self.seed()
+
+    def seed(self):
+        '''
+        Reads the remaining requests and reset time of every key for every
+        method from twitter's rate limit status. Keys whose status can't be
+        read (e.g. apis without GetRateLimitStatus) keep their current
+        counts. Returns nothing.
+        '''
+
+        for i, api in enumerate(self.apis):
+            try:
+                status = api.GetRateLimitStatus()
+            except (AttributeError, twitter.error.TwitterError):
+                continue
+
+            resources = status.get('resources', {})
+
+            with self.lock:
+                for method in self.limits:
+                    family, endpoint = RATE_RESOURCES.get(method, (None, None))
+                    limit = resources.get(family, {}).get(endpoint)
+
+                    if limit is None:
+                        continue
+
+                    self.remaining[method][i] = limit['remaining']
+                    self.reset[method][i] = limit['reset']
+
+    def __getattr__(self, name):
+        if name not in self.__dict__.get('limits', {}):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            return self.request(name, *args, **kwargs)
+
+        return call
+
+    def acquire(self, method):
+        '''
+        Reserves one request for method on the key with the most requests
+        left, waiting for a reset if all keys are exhausted.
+
+        return: Index of the reserved key in apis.
+        '''
+
+        while True:
+            with self.lock:
+                now = self.clock()
+                remaining = self.remaining[method]
+                reset = self.reset[method]
+
+                for i in range(len(self.apis)):
+                    if reset[i] is not None and now >= reset[i]:
+                        remaining[i] = self.limits[method]
+                        reset[i] = None
+
+                best = max(range(len(self.apis)), key=remaining.__getitem__)
+
+                if remaining[best] > 0:
+                    remaining[best] -= 1
+                    if reset[best] is None:
+                        reset[best] = now + self.window
+                    return best
+
+                wait = min(r for r in reset if r is not None) - now
+
+            self.sleep(max(wait, 0))
+
+    def exhausted(self, index, method):
+        ''' Marks a key as out of requests for method (e.g. on error 88). '''
+
+        with self.lock:
+            self.remaining[method][index] = 0
+            if self.reset[method][index] is None:
+                self.reset[method][index] = self.clock() + self.window
+
+    def call(self, method, function, *args, **kwargs):
+        '''
+        Calls function(api, *args, **kwargs) with the best available key,
+        counting it as one request to the api method. If twitter reports
+        that the key is rate limited, it is marked as exhausted and the call
+        is retried on another key.
+
+        Useful for requests the twitter module doesn't expose directly,
+        e.g. a single page of a cursored call.
+
+        return: Result of the function.
+        '''
+
+        while True:
+            index = self.acquire(method)
+
+            try:
+                return function(self.apis[index], *args, **kwargs)
+
+            except twitter.error.TwitterError as err:
+                if '88' not in str(err):
+                    raise
+                self.exhausted(index, method)
+
+    def request(self, method, *args, **kwargs):
+        '''
+        Calls the api method on the best available key (see call).
+
+        return: Result of the api call.
+        '''
+
+        def api_method(api, *args, **kwargs):
+            return getattr(api, method)(*args, **kwargs)
+
+        return self.call(method, api_method, *args, **kwargs)
+
+    def status(self):
+        '''
+        return: Dictionary of api method: list of (remaining requests, seconds
+        until reset) tuples, one per key.
+        '''
+
+        with self.lock:
+            now = self.clock()
+            return {m: [(n, None if r is None else max(r - now, 0))
+                        for n, r in zip(self.remaining[m], self.reset[m])]
+                    for m in self.limits}
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import gzip
+import json
+import os
+import tempfile
+import numpy as np
+
+# Escaped so that the json can be embedded in a <script> tag as is, like
+# jinja's tojson filter does. These are valid json escapes.
+HTML_ESCAPES = (('<', '\\u003c'),
+                ('>', '\\u003e'),
+                ('&', '\\u0026'),
+                ("'", '\\u0027'),
+                )
+
+
+def to_native(obj):
+    '''
+    Recursively converts numpy scalars and arrays (and tuples) in a json
+    object to python types, so it can be serialized without numpy.
+
+    obj: Dictionary/list/scalar, e.g. a community json object.
+
+    return: Object of the same structure.
+    '''
+
+    if isinstance(obj, dict):
+        return {to_native(k): to_native(v) for k, v in obj.iteritems()}
+
+    if isinstance(obj, (list, tuple)):
+        return [to_native(x) for x in obj]
+
+    if isinstance(obj, np.ndarray):
+        return to_native(obj.tolist())
+
+    if isinstance(obj, np.generic):
+        return obj.item()
+
+    return obj
+
+
+def dumps(community_json):
+    '''
+    Serializes a community json object canonically: python types only,
+    sorted keys, no whitespace, ascii and html safe. The same graph always
+    gives the same string.
+
+    return: String.
+    '''
+
+    text = json.dumps(to_native(community_json), sort_keys=True,
+                      separators=(',', ':'))
+
+    for char, escaped in HTML_ESCAPES:
+        text = text.replace(char, escaped)
+
+    return text
+
+
+def write_json(community_json, path):
+    '''
+    Writes the serialized community json to path, and a gzipped copy to
+    path + '.gz', for serving as is. Both are written to temporary files
+    of their own first, so neither a reader nor a concurrent writer ever
+    sees a partial file. Returns nothing.
+    '''
+
+    text = dumps(community_json)
+    directory = os.path.dirname(path) or '.'
+
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(text)
+
+    fd, gz_tmp = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        gz = gzip.GzipFile(filename=os.path.basename(path), fileobj=f,
+                           mode='wb', mtime=0)
+        gz.write(text)
+        gz.close()
+
+    # mkstemp files are only readable by their owner
+    for fn in (tmp, gz_tmp):
+        os.chmod(fn, 0644)
+
+    os.rename(gz_tmp, path + '.gz')
+    os.rename(tmp, path)
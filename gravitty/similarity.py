@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
+import multiprocessing
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 
 FOLLOWING_EACH_OTHER_WEIGHT = 10.
 FOLLOWING_ONE_WAY_WEIGHT = 5.
@@ -15,6 +17,20 @@ SHARED_URLS_WEIGHT = 1.
 
 MENTION_OTHER_USER_WEIGHT = 10.
 
+PAIR_BATCH_SIZE = 100000
+BLOCK_SIZE = 2000
+
+def weight_constants():
+    '''
+    return: Dictionary of the scoring weights set above, by name, e.g. to
+    invalidate cached scores when they are changed.
+    '''
+    return {k: v for k, v in globals().iteritems() if k.endswith('_WEIGHT')}
+
+
+# Feature matrices shared with the similarity_components worker processes
+__SHARED_FEATURES = None
+
 
 def compute_similarity(user1_id, user1, user2_id, user2):
     '''
@@ -80,22 +96,415 @@ def compute_similarity(user1_id, user1, user2_id, user2):
     return similarity
 
 
-def make_similarity_dataframe(df):
+def __interned(values):
+    ''' True if values are interned feature ids (see vocab.py). '''
+    return len(values) > 0 and isinstance(values[0], np.ndarray)
+
+
+def __interned_rows(values):
+    '''
+    return: Tuple of the row and feature id arrays of every feature in a
+    list of interned feature id arrays.
+    '''
+    lengths = [len(x) for x in values]
+    rows = np.repeat(np.arange(len(values)), lengths)
+    return rows, np.concatenate(values).astype(np.int64)
+
+
+def __incidence_matrix(values):
+    '''
+    Encodes each user's set of features as a row of a sparse user x feature
+    incidence matrix. Features are numbered in order of first appearance,
+    or by their id if they were interned (see vocab.intern_dataframe).
+
+    values: Iterable of sets/lists (or interned id arrays), one per user.
+
+    return: Scipy CSR matrix with a 1 wherever a user has a feature.
+    '''
+
+    values = list(values)
+
+    if __interned(values):
+        rows, cols = __interned_rows(values)
+        n_cols = cols.max() + 1 if len(cols) else 0
+        return sp.csr_matrix((np.ones(len(rows)), (rows, cols)),
+                             shape=(len(values), n_cols))
+
+    vocab = {}
+    rows, cols = [], []
+
+    for row, features in enumerate(values):
+        for feature in features:
+            rows.append(row)
+            cols.append(vocab.setdefault(feature, len(vocab)))
+
+    return sp.csr_matrix((np.ones(len(rows)), (rows, cols)),
+                         shape=(len(values), len(vocab)))
+
+
+def __adjacency_matrix(values, position):
+    '''
+    Encodes each user's set of user ids (followers, mentions, etc.) as a row
+    of a sparse user x user adjacency matrix. Ids that are not in the
+    dataframe are ignored.
+
+    values: Iterable of sets/lists of user ids (or interned user id
+    arrays, whose ids below len(position) are rows), one per user.
+    position: Dictionary mapping user id to row number.
+
+    return: Scipy CSR matrix where [i, j] is 1 if user j is in values[i].
+    '''
+
+    values = list(values)
+    n = len(position)
+
+    if __interned(values):
+        rows, cols = __interned_rows(values)
+        inside = cols < n
+        return sp.csr_matrix((np.ones(inside.sum()),
+                              (rows[inside], cols[inside])), shape=(n, n))
+
+    rows, cols = [], []
+
+    for row, ids in enumerate(values):
+        for uid in ids:
+            col = position.get(uid)
+            if col is not None:
+                rows.append(row)
+                cols.append(col)
+
+    return sp.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(n, n))
+
+
+def __features(df, weights=None):
+    '''
+    Sparse matrices the scores of similarity_components are made of.
+
+    return: Tuple of the symmetric direct (follow/mention) score matrix,
+    the stacked weighted and unweighted feature incidence matrices (the
+    shared scores are weighted * unweighted.T) and the baseline flags.
+    '''
+
+    n = df.shape[0]
+    position = {uid: i for i, uid in enumerate(df.index)}
+
+    # compute_similarity scores each pair with the earlier user in the index
+    # as user1 and only looks at user1's follower/following lists, so the
+    # follow terms are taken from the upper triangle and mirrored.
+    follows = __adjacency_matrix(df['following'], position)
+    followed_by = __adjacency_matrix(df['followers'], position)
+    one_way = follows + followed_by - 2 * follows.multiply(followed_by)
+
+    direct = sp.triu(FOLLOWING_EACH_OTHER_WEIGHT * follows +
+                     FOLLOWING_ONE_WAY_WEIGHT * one_way, k=1)
+    direct = direct + direct.T
+
+    mentions = __adjacency_matrix(df['mentions'], position)
+    direct = direct + MENTION_OTHER_USER_WEIGHT * (mentions + mentions.T)
+
+    following = __incidence_matrix(df['following'])
+    kept = np.arange(following.shape[1])
+    baseline = np.zeros(n)
+
+    if following.shape[1] > 0:
+        counts = np.asarray(following.sum(axis=0)).ravel()
+        top = counts.argmax()
+        baseline = following[:, top].toarray().ravel()
+        kept = kept[kept != top]
+        following = following[:, kept]
+
+    families = [('followers', __incidence_matrix(df['followers']),
+                 SHARED_FOLLOWERS_WEIGHT),
+                ('following', following, SHARED_FOLLOWING_WEIGHT),
+                ('list', __incidence_matrix(df['list']), SHARED_LIST_WEIGHT),
+                ('mentions', __incidence_matrix(df['mentions']),
+                 SHARED_MENTION_WEIGHT),
+                ('hashtags', __incidence_matrix(df['hashtags']),
+                 SHARED_HASHTAG_WEIGHT),
+                ('urls', __incidence_matrix(df['urls']), SHARED_URLS_WEIGHT)]
+
+    if weights is not None:
+        baseline = np.ones(n)
+
+    # sum_k w_k * A_k * W_k * A_k.T as a single product of stacked matrices,
+    # where W_k is the diagonal matrix of per feature weights, if any.
+    weighted, unweighted = [], []
+
+    for column, a, weight in families:
+        unweighted.append(a)
+
+        if weights is not None and a.shape[1] > 0:
+            ids = kept if column == 'following' else np.arange(a.shape[1])
+            a = a * sp.diags(weights[column][ids], 0)
+
+        weighted.append(weight * a)
+
+    weighted = sp.hstack(weighted).tocsr()
+    unweighted = sp.hstack(unweighted).tocsr()
+
+    return direct, weighted, unweighted, baseline
+
+
+def __shared_block(block):
+    '''
+    Process pool worker: CSR matrix of the shared scores of rows start:end
+    with every user.
+    '''
+    start, end = block
+    weighted, unweighted_t = __SHARED_FEATURES
+    return weighted[start:end] * unweighted_t
+
+
+def similarity_components(df, weights=None, workers=1,
+                          block_size=BLOCK_SIZE):
+    '''
+    Vectorized equivalent of running compute_similarity on every pair of
+    users. Each feature family is encoded as a sparse incidence matrix A so
+    that the shared feature counts for every pair are the entries of A * A.T.
+    The direct follow/mention terms come from sparse adjacency matrices.
+
+    compute_similarity subtracts one from the shared following count of every
+    pair (the target user, followed by everyone). To keep the result sparse,
+    the most followed account is dropped from the following matrix and the
+    offset is returned separately as a per-user flag: the full score of a
+    pair (i, j) is
+
+        scores[i, j] + SHARED_FOLLOWING_WEIGHT * (baseline[i]*baseline[j] - 1)
+
+    for i != j, and zero on the diagonal.
+
+    If weights are given, each shared feature counts its weight (e.g. its
+    inverse frequency, see frequency.idf_weights) rather than one, i.e.
+    A * diag(weights) * A.T. The most followed account is then simply left
+    out of the shared following scores and baseline is all ones.
+
+    With workers > 1 (None for one per cpu), the shared scores are computed
+    in blocks of block_size rows in a process pool. Workers are forked
+    after the feature matrices are built, so they share them read-only
+    instead of receiving a pickled copy of df. Only the score blocks are
+    sent back.
+
+    df: Pandas Dataframe. Should contain the parsed data produced from
+    parse_dataframe(), optionally interned by vocab.intern_dataframe().
+    weights: Dictionary of column name: numpy array of per feature weights,
+    indexed by interned feature id. Requires an interned df. Optional.
+    workers: Integer or None.
+    block_size: Integer.
+
+    return: Tuple of symmetric Scipy CSR matrix (rows/columns ordered as
+    df.index, zero diagonal) and numpy array of baseline flags.
+    '''
+
+    global __SHARED_FEATURES
+
+    n = df.shape[0]
+    direct, weighted, unweighted, baseline = __features(df, weights)
+    blocks = [(start, min(start + block_size, n))
+              for start in xrange(0, n, block_size)]
+
+    if workers == 1 or len(blocks) < 2:
+        shared = weighted * unweighted.T
+    else:
+        __SHARED_FEATURES = (weighted, unweighted.T.tocsr())
+        try:
+            pool = multiprocessing.Pool(workers)
+            try:
+                shared = sp.vstack(pool.map(__shared_block, blocks)).tocsr()
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            __SHARED_FEATURES = None
+
+    scores = (direct + shared).tocsr()
+    scores = scores - sp.diags(scores.diagonal(), 0)
+    scores.eliminate_zeros()
+
+    return scores, baseline
+
+
+class SimilarityMatrix(object):
+    '''
+    Sparse, symmetric similarity scores for a set of users. Rows/columns of
+    matrix are ordered as index, and position maps a user id back to its
+    row.
+
+    Only pairs with a direct relationship or a shared feature are stored.
+    Every other pair (i, j) scores SHARED_FOLLOWING_WEIGHT * (baseline[i] *
+    baseline[j] - 1), which is never positive and so never becomes an edge
+    (see similarity_components).
+    '''
+
+    def __init__(self, matrix, index, baseline=None):
+        self.matrix = sp.csr_matrix(matrix)
+        self.index = list(index)
+        self.position = {uid: i for i, uid in enumerate(self.index)}
+
+        if baseline is None:
+            baseline = np.ones(len(self.index))
+        self.baseline = np.asarray(baseline, dtype=float)
+
+    @classmethod
+    def from_dataframe(cls, df_similarity):
+        '''
+        Builds a SimilarityMatrix from a square similarity dataframe, such as
+        the one produced by make_similarity_dataframe.
+        '''
+        return cls(sp.csr_matrix(df_similarity.values), df_similarity.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def score(self, user1_id, user2_id):
+        ''' Returns the similarity score between two user ids. '''
+        i, j = self.position[user1_id], self.position[user2_id]
+
+        if i == j:
+            return 0.
+
+        row = self.matrix.indices[self.matrix.indptr[i]:
+                                  self.matrix.indptr[i + 1]]
+        found = np.flatnonzero(row == j)
+
+        if len(found):
+            return self.matrix.data[self.matrix.indptr[i] + found[0]]
+
+        return SHARED_FOLLOWING_WEIGHT * \
+               (self.baseline[i] * self.baseline[j] - 1)
+
+    def edges(self):
+        '''
+        return: List of (user1_id, user2_id, score) tuples for every pair in
+        the upper triangle with a positive score.
+        '''
+
+        upper = sp.triu(self.matrix, k=1).tocoo()
+        positive = upper.data > 0
+
+        ids = np.empty(len(self.index), dtype=object)
+        ids[:] = self.index
+
+        return zip(ids[upper.row[positive]], ids[upper.col[positive]],
+                   upper.data[positive].tolist())
+
+    def to_dataframe(self):
+        '''
+        Dense view of the scores. Allocates n x n floats, so only use this
+        for small sets of users.
+
+        return: Pandas Dataframe indexed & columned by user_id, identical to
+        make_similarity_dataframe(df, vectorized=False).
+        '''
+
+        dense = SHARED_FOLLOWING_WEIGHT * \
+                (np.outer(self.baseline, self.baseline) - 1)
+
+        coo = self.matrix.tocoo()
+        dense[coo.row, coo.col] = coo.data
+        np.fill_diagonal(dense, 0.)
+
+        return pd.DataFrame(data=dense, index=self.index, columns=self.index)
+
+
+def make_similarity_matrix(df, weights=None, workers=1):
+    '''
+    Performs the latent similarity calculation on every pair of users in the
+    provided user dataframe without allocating a dense n x n matrix.
+
+    See compute_similarity for additional details on how this score is
+    computed.
+
+    df: Pandas Dataframe. Should contain the parsed data produced from
+    parse_dataframe(), optionally interned by vocab.intern_dataframe().
+    weights: Dictionary of per feature weights for an interned df, see
+    similarity_components. Optional.
+    workers: Integer or None. Number of processes computing the scores,
+    see similarity_components.
+
+    return: SimilarityMatrix indexed by df.index.
+    '''
+
+    scores, baseline = similarity_components(df, weights, workers)
+
+    # Apply the shared following offset to the stored pairs only. Explicit
+    # zeros are kept so that stored pairs never fall back to the offset.
+    rows = np.repeat(np.arange(scores.shape[0]), np.diff(scores.indptr))
+    scores.data += SHARED_FOLLOWING_WEIGHT * \
+                   (baseline[rows] * baseline[scores.indices] - 1)
+
+    return SimilarityMatrix(scores, df.index, baseline)
+
+
+def score_pairs(df, rows, cols, weights=None, batch_size=PAIR_BATCH_SIZE):
+    '''
+    Exact similarity scores (as make_similarity_matrix) of the given pairs
+    of users only, e.g. candidate pairs found by lsh.candidate_pairs. Each
+    pair costs the size of its two feature rows, so this scales with the
+    number of pairs instead of the number of users squared.
+
+    df: Pandas Dataframe. Should contain the parsed data produced from
+    parse_dataframe(), optionally interned by vocab.intern_dataframe().
+    rows, cols: Numpy integer arrays of row numbers in df. Pairs should be
+    distinct (i, j) with i < j.
+    weights: Dictionary of per feature weights for an interned df, see
+    similarity_components. Optional.
+    batch_size: Integer. Number of pairs scored at once.
+
+    return: SimilarityMatrix indexed by df.index, storing the given pairs.
+    '''
+
+    direct, weighted, unweighted, baseline = __features(df, weights)
+    direct = direct.tocsr()
+
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    scores = np.empty(len(rows))
+
+    for start in xrange(0, len(rows), batch_size):
+        r = rows[start:start + batch_size]
+        c = cols[start:start + batch_size]
+
+        shared = weighted[r].multiply(unweighted[c]).sum(axis=1)
+        scores[start:start + batch_size] = \
+            np.asarray(shared).ravel() + np.asarray(direct[r, c]).ravel() + \
+            SHARED_FOLLOWING_WEIGHT * (baseline[r] * baseline[c] - 1)
+
+    n = df.shape[0]
+    matrix = sp.csr_matrix((np.concatenate([scores, scores]),
+                            (np.concatenate([rows, cols]),
+                             np.concatenate([cols, rows]))), shape=(n, n))
+
+    return SimilarityMatrix(matrix, df.index, baseline)
+
+
+def make_similarity_dataframe(df, vectorized=True, weights=None, workers=1):
     '''
     Performs a pair-wise latent similarity calculation on every pair of users
     in the provided user dataframe. Produces a dataframe instead of a numpy
-    matrix for easier indexing by downstream functions.
+    matrix for easier indexing by downstream functions. This is a dense view
+    and is only suitable for small sets of users; use make_similarity_matrix
+    otherwise.
 
     See compute_similarity for additional details on how this score is
     computed.
 
     df: Pandas Dataframe. Should contain the parsed data produced from
     parse_dataframe().
+    vectorized: Boolean. If true, scores are computed with sparse matrix
+    products (see similarity_components), otherwise compute_similarity is
+    called on every pair. Both produce the same scores.
+    weights: Dictionary of per feature weights for an interned df, see
+    similarity_components. Only used if vectorized.
+    workers: Integer or None. Number of processes computing the scores, see
+    similarity_components. Only used if vectorized.
 
     return: Pandas Dataframe indexed & columned by user_id. Similarity
     scores are undirected.
     '''
 
+    if vectorized:
+        return make_similarity_matrix(df, weights, workers).to_dataframe()
+
     similarity_df = pd.DataFrame(data=np.zeros([df.shape[0]]*2),
                                  index=df.index, columns=df.index)
 
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import scipy.sparse as sp
+from similarity import SimilarityMatrix
+from community import best_partition, modularity, complete_partition
+
+
+def __positive_entries(df_similarity):
+    '''
+    df_similarity: SimilarityMatrix or square similarity dataframe.
+
+    return: Tuple of SimilarityMatrix and a COO matrix holding only its
+    positive (i.e. edge-producing) entries.
+    '''
+
+    if not isinstance(df_similarity, SimilarityMatrix):
+        df_similarity = SimilarityMatrix.from_dataframe(df_similarity)
+
+    coo = df_similarity.matrix.tocoo()
+    positive = coo.data > 0
+
+    coo = sp.coo_matrix((coo.data[positive],
+                         (coo.row[positive], coo.col[positive])),
+                        shape=coo.shape)
+
+    return df_similarity, coo
+
+
+def __keep(coo, mask):
+    ''' Symmetric COO matrix of the entries in mask or mirrored in mask. '''
+
+    kept = sp.coo_matrix((mask.astype(float), (coo.row, coo.col)),
+                         shape=coo.shape).tocsr()
+    kept = kept + kept.T
+
+    return coo.tocsr().multiply(kept > 0).tocoo()
+
+
+def threshold_filter(coo, min_weight):
+    ''' Keeps edges whose weight is at least min_weight. '''
+    return __keep(coo, coo.data >= min_weight)
+
+
+def top_k_filter(coo, k):
+    '''
+    Keeps, for every user, the edges to its k strongest neighbors. An edge
+    is kept if either of its users ranks the other in its top k.
+    '''
+
+    order = np.lexsort((-coo.data, coo.row))
+    rows = coo.row[order]
+
+    # Rank of each entry within its row, strongest first
+    starts = np.searchsorted(rows, rows, side='left')
+    rank = np.empty(len(order), dtype=int)
+    rank[order] = np.arange(len(order)) - starts
+
+    return __keep(coo, rank < k)
+
+
+def disparity_filter(coo, alpha):
+    '''
+    Extracts the multiscale backbone of the weighted graph (Serrano, Boguna
+    & Vespignani, PNAS 2009). An edge is kept if it is statistically
+    significant at level alpha for either of its users, given their
+    strength and degree.
+    '''
+
+    csr = coo.tocsr()
+    strength = np.asarray(csr.sum(axis=1)).ravel()
+    degree = np.diff(csr.indptr)
+
+    p = coo.data / strength[coo.row]
+    significance = (1. - p) ** (degree[coo.row] - 1)
+
+    return __keep(coo, significance < alpha)
+
+
+def sparsify_similarity(df_similarity, min_weight=None, top_k=None,
+                        alpha=None):
+    '''
+    Prunes weak edges from the similarity matrix before community detection.
+    Nearly every pair of followers shares something (a hashtag, a url),
+    so without pruning the graph handed to Louvain is close to complete.
+
+    Filters are applied in the order below; any left as None are skipped.
+    Pruned pairs are treated as unscored and never become edges.
+
+    df_similarity: SimilarityMatrix or square similarity dataframe.
+    min_weight: Float. Drop edges with a lower weight.
+    top_k: Integer. Keep each user's k strongest edges.
+    alpha: Float. Keep edges in the disparity filter backbone at this
+    significance level (e.g. 0.05).
+
+    return: SimilarityMatrix containing only the kept edges.
+    '''
+
+    df_similarity, coo = __positive_entries(df_similarity)
+
+    if min_weight is not None:
+        coo = threshold_filter(coo, min_weight)
+
+    if top_k is not None:
+        coo = top_k_filter(coo, top_k)
+
+    if alpha is not None:
+        coo = disparity_filter(coo, alpha)
+
+    return SimilarityMatrix(coo.tocsr(), df_similarity.index,
+                            df_similarity.baseline)
+
+
+def sparsification_report(graph, sparse_graph, partition=None,
+                          reference=None):
+    '''
+    Measures what was lost by sparsifying a similarity graph, so that the
+    filters can be tuned per account.
+
+    Modularity is always measured on the full graph. Runs the louvain method
+    on either graph when its partition is not provided, so this is meant
+    for offline tuning rather than every load: see sparsification_summary
+    for a cheap report without the reference communities.
+
+    graph: Networkx graph built from the full similarity matrix.
+    sparse_graph: Networkx graph built from the sparsified matrix.
+    partition: Dictionary of user_id: community_id found on sparse_graph.
+    reference: Dictionary of user_id: community_id found on graph.
+
+    return: Dictionary with edges_total, edges_kept, weight_kept (fraction),
+    modularity (of partition), modularity_reference and modularity_lost.
+    '''
+
+    if partition is None:
+        partition = best_partition(sparse_graph)
+
+    if reference is None:
+        reference = best_partition(graph)
+
+    partition = complete_partition(partition, graph)
+
+    q = modularity(partition, graph)
+    q_reference = modularity(reference, graph)
+
+    weight_total = graph.size(weight='weight')
+
+    return {'edges_total': graph.number_of_edges(),
+            'edges_kept': sparse_graph.number_of_edges(),
+            'weight_kept': sparse_graph.size(weight='weight') / weight_total,
+            'modularity': q,
+            'modularity_reference': q_reference,
+            'modularity_lost': q_reference - q,
+            }
+
+
+def sparsification_summary(df_similarity, sparse_graph, partition):
+    '''
+    The cheap part of sparsification_report: the edges and weight kept, and
+    the modularity of the sparse graph's communities measured on the full
+    similarity matrix. Works on the matrix directly, so neither the full
+    graph nor its communities are built.
+
+    df_similarity: SimilarityMatrix or square similarity dataframe that was
+    sparsified.
+    sparse_graph: Networkx graph built from the sparsified matrix.
+    partition: Dictionary of user_id: community_id found on sparse_graph.
+    Users it leaves out are alone in their community.
+
+    return: Dictionary with edges_total, edges_kept, weight_kept (fraction)
+    and modularity (of partition).
+    '''
+
+    df_similarity, coo = __positive_entries(df_similarity)
+
+    # Graph edges are the upper triangle, see SimilarityMatrix.edges
+    upper = coo.row < coo.col
+    rows, cols, weights = coo.row[upper], coo.col[upper], coo.data[upper]
+    links = weights.sum()
+
+    communities = {}
+    labels = np.array([communities.setdefault(partition.get(uid, (None, i)),
+                                              len(communities))
+                       for i, uid in enumerate(df_similarity.index)],
+                      dtype=int)
+
+    same = labels[rows] == labels[cols]
+    inside = np.bincount(labels[rows[same]], weights=weights[same],
+                         minlength=len(communities))
+    degree = np.bincount(labels[rows], weights=weights,
+                         minlength=len(communities)) + \
+        np.bincount(labels[cols], weights=weights,
+                    minlength=len(communities))
+
+    q = (inside / links - (degree / (2. * links)) ** 2).sum() if links \
+        else 0.
+
+    return {'edges_total': len(weights),
+            'edges_kept': sparse_graph.number_of_edges(),
+            'weight_kept': sparse_graph.size(weight='weight') / links,
+            'modularity': q,
+            }
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import pickle
+
+STAGE_FILE_EXT = 'pkl'
+
+# Bump whenever a stage's code or artifact format changes, so artifacts
+# saved by older code are never loaded
+STAGE_VERSION = 2
+
+
+def stage_key(*inputs):
+    '''
+    Hashes the inputs of a pipeline stage: the key of the stage it depends
+    on and the parameters it runs with, along with STAGE_VERSION.
+
+    inputs: Any json serializable objects (others are hashed by their repr).
+
+    return: String. Hex digest.
+    '''
+    return hashlib.md5(json.dumps((STAGE_VERSION,) + inputs, sort_keys=True,
+                                  default=repr)).hexdigest()
+
+
+class StageCache(object):
+    '''
+    Stores the result (artifact) of each stage of the load pipeline as a
+    pickle named <stage>.<key>.pkl in one directory per account. Only the
+    latest artifact of each stage is kept.
+
+    Since the key of a stage includes the key of the stage before it, a
+    changed input or parameter invalidates that stage and every stage after
+    it, and nothing before it.
+
+    path: String. Directory for the artifacts, created if needed.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def __file(self, stage, key):
+        return os.path.join(self.path,
+                            '%s.%s.%s' % (stage, key, STAGE_FILE_EXT))
+
+    def load(self, stage, key):
+        '''
+        return: The artifact saved for stage under key, or None.
+        '''
+
+        fn = self.__file(stage, key)
+
+        if not os.path.isfile(fn):
+            return None
+
+        with open(fn, 'rb') as f:
+            return pickle.load(f)
+
+    def latest(self, stage):
+        '''
+        return: The artifact currently saved for stage, whatever its key,
+        or None.
+        '''
+
+        for fn in os.listdir(self.path):
+            if fn.split('.')[0] == stage and \
+                    fn.endswith('.' + STAGE_FILE_EXT):
+                with open(os.path.join(self.path, fn), 'rb') as f:
+                    return pickle.load(f)
+
+        return None
+
+    def save(self, stage, key, artifact):
+        '''
+        Saves the artifact of stage under key, replacing the stage's
+        previous artifact. The pickle is written to a temporary file first,
+        so an interrupted save never leaves a partial artifact behind.
+        '''
+
+        fn = self.__file(stage, key)
+
+        with open(fn + '.tmp', 'wb') as f:
+            pickle.dump(artifact, f, pickle.HIGHEST_PROTOCOL)
+
+        os.rename(fn + '.tmp', fn)
+
+        for other in os.listdir(self.path):
+            if other.split('.')[0] == stage and \
+                    os.path.join(self.path, other) != fn:
+                os.remove(os.path.join(self.path, other))
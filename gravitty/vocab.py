@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+
+# Columns of user ids, which share one vocabulary, and of other features
+USER_COLUMNS = ('followers', 'following', 'mentions')
+FEATURE_COLUMNS = ('list', 'hashtags', 'urls')
+
+
+class Vocabulary(object):
+    '''
+    Maps features (hashtags, urls, list or user ids) to dense integer ids,
+    numbered in order of first appearance.
+
+    features: Iterable of features to number first. Optional.
+    '''
+
+    def __init__(self, features=()):
+        self.ids = {}
+        self.features = []
+
+        for feature in features:
+            self.id(feature)
+
+    def __len__(self):
+        return len(self.features)
+
+    def id(self, feature):
+        ''' return: Integer id of feature, numbering it if it is new. '''
+
+        i = self.ids.get(feature)
+
+        if i is None:
+            i = self.ids[feature] = len(self.features)
+            self.features.append(feature)
+
+        return i
+
+    def intern(self, features):
+        '''
+        features: Set/list of features.
+
+        return: Sorted numpy int32 array of their ids.
+        '''
+
+        ids = np.fromiter((self.id(f) for f in features), dtype=np.int32,
+                          count=len(features))
+        ids.sort()
+
+        return ids
+
+    def decode(self, ids):
+        ''' return: List of the features with the given ids. '''
+        return [self.features[i] for i in ids]
+
+
+def intern_dataframe(df):
+    '''
+    Replaces each user's sets of followers, friends, mentions, lists,
+    hashtags and urls with sorted int32 arrays of dense feature ids, which
+    take a fraction of the memory of python sets and can be turned into
+    sparse matrices without hashing (see similarity.similarity_components).
+
+    All user id columns share one vocabulary, 'users', which numbers the
+    users of df first: user id i < len(df) is the i-th row of df. Rows
+    should not be filtered or reordered after interning.
+
+    df: Pandas Dataframe produced by parse_dataframe.
+
+    return: Tuple of a copy of df with interned columns and a dictionary of
+    vocabulary name ('users' or the column name): Vocabulary.
+    '''
+
+    interned = df.copy()
+
+    users = Vocabulary(df.index.tolist())
+    vocabularies = {'users': users}
+
+    for column in USER_COLUMNS:
+        interned[column] = pd.Series([users.intern(x) for x in df[column]],
+                                     index=df.index)
+
+    for column in FEATURE_COLUMNS:
+        vocab = vocabularies[column] = Vocabulary()
+        interned[column] = pd.Series([vocab.intern(x) for x in df[column]],
+                                     index=df.index)
+
+    return interned, vocabularies
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from main import cache_file, JSON_FILE_EXT
+from serialize import to_native, dumps, write_json
+
+COMMUNITY_CACHE_SIZE = 32
+
+
+class CommunityCache(object):
+    '''
+    Bounded, least recently used cache of community json objects (see
+    load), converted to python types and serialized. Entries
+    are keyed by screen name and the modification time of the account's
+    pickle, so rewriting the pickle invalidates its entry. Safe to share
+    between threads.
+
+    maxsize: Integer. Maximum number of accounts kept in memory.
+    '''
+
+    def __init__(self, maxsize=COMMUNITY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, screen_name):
+        '''
+        return: Community json object of screen_name, or None if it hasn't
+        been analyzed.
+        '''
+        entry = self.__entry(screen_name)
+        return None if entry is None else entry[1]
+
+    def get_text(self, screen_name):
+        '''
+        return: Serialized community json of screen_name (see
+        serialize.dumps), or None if it hasn't been analyzed.
+        '''
+        entry = self.__entry(screen_name)
+        return None if entry is None else entry[2]
+
+    def json_file(self, screen_name):
+        '''
+        Path of the serialized community json of screen_name (load writes it
+        along with a gzipped copy at path + '.gz'). It is written here for
+        accounts analyzed before load did so, or if it is older than the
+        pickle.
+
+        return: String, or None if the account hasn't been analyzed.
+        '''
+
+        fn = cache_file(screen_name, JSON_FILE_EXT)
+
+        try:
+            mtime = os.path.getmtime(cache_file(screen_name))
+        except OSError:
+            return None
+
+        if not os.path.isfile(fn) or os.path.getmtime(fn) < mtime:
+            community_json = self.get(screen_name)
+            if community_json is None:
+                return None
+            write_json(community_json, fn)
+
+        return fn
+
+    def __entry(self, screen_name):
+        ''' return: Tuple of (mtime, community json, text) or None. '''
+
+        fn = cache_file(screen_name)
+
+        try:
+            mtime = os.path.getmtime(fn)
+        except OSError:
+            return None
+
+        with self.lock:
+            entry = self.entries.pop(screen_name, None)
+
+            if entry is not None and entry[0] == mtime:
+                self.hits += 1
+                self.entries[screen_name] = entry
+                return entry
+
+            self.misses += 1
+
+        with open(fn, 'rb') as f:
+            community_json = to_native(pickle.load(f))
+
+        entry = (mtime, community_json, dumps(community_json))
+
+        with self.lock:
+            self.entries[screen_name] = entry
+
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+        return entry
+
+    def stats(self):
+        '''
+        return: Dictionary of hits, misses, size (number of cached accounts)
+        and maxsize.
+        '''
+
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self.entries), 'maxsize': self.maxsize}
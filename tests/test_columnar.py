@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'gravitty'))
+
+from columnar import write_raw
+from parse import filter_dataframe, parse_dataframe
+
+
+def raw_dataframe():
+    '''
+    Small synthetic stand-in for get_follower_data's output, with the
+    fields parse_dataframe reads plus some it doesn't.
+    '''
+
+    tweets = {
+        1: [{'id': 10, 'text': u'caf\xe9 time', 'lang': 'en',
+             'hashtags': [u'Caf\xe9', u'Python'],
+             'urls': [[u'http://a.co/1', u'http://example.com/1']],
+             'user_mentions': [{'id': 2, 'screen_name': u'two'}],
+             'retweet_count': 4},
+            {'id': 11, 'text': u'hola', 'lang': 'es', 'hashtags': [],
+             'urls': [], 'user_mentions': []}],
+        2: [{'id': 20, 'text': u'hi @one', 'lang': 'en',
+             'hashtags': [u'python'], 'urls': [],
+             'user_mentions': [{'id': 1, 'screen_name': u'one'},
+                               {'id': 99, 'screen_name': u'other'}]}],
+        3: [],
+    }
+
+    rows = [
+        {'info': {'screen_name': u'one', 'name': u'J\xfcrgen',
+                  'location': u'Z\xfcrich', 'followers_count': 2},
+         'tweets': tweets[1], 'followers': [2, 3], 'following': [2, 50],
+         'list': [{'id': 7, 'name': u'friends'}]},
+        # Like AsDict, info dictionaries leave out empty fields
+        {'info': {'screen_name': u'two', 'name': u'Two'},
+         'tweets': tweets[2], 'followers': [1], 'following': [1, 3, 50],
+         'list': np.nan},
+        {'info': {'screen_name': u'three', 'name': u'', 'location': u''},
+         'tweets': tweets[3], 'followers': [], 'following': [50],
+         'list': [{'id': 7, 'name': u'friends'}, {'id': 8, 'name': u'x'}]},
+    ]
+
+    return pd.DataFrame(rows, index=[1, 2, 3])
+
+
+class RawStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.raw_df = raw_dataframe()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, name, full=False):
+        return write_raw(self.raw_df, os.path.join(self.path, name), full)
+
+    def test_parses_like_raw_dataframe(self):
+        expected = parse_dataframe(filter_dataframe(self.raw_df))
+        found = parse_dataframe(filter_dataframe(self.write('raw')
+                                                 .dataframe()))
+
+        self.assertEqual(found.to_dict(), expected.to_dict())
+
+    def test_columns(self):
+        df = self.write('raw').dataframe()
+
+        self.assertEqual(df.index.tolist(), self.raw_df.index.tolist())
+        self.assertEqual(df['followers'].tolist(),
+                         self.raw_df['followers'].tolist())
+        self.assertEqual(df['list'].tolist(),
+                         [[{'id': 7}], [], [{'id': 7}, {'id': 8}]])
+        self.assertEqual(df['info'][2], {'screen_name': u'two',
+                                         'name': u'Two', 'location': u''})
+        self.assertEqual([t['id'] for t in df['tweets'][1]], [10, 11])
+        self.assertEqual(df['tweets'][3], [])
+
+    def test_full_objects(self):
+        store = self.write('full', full=True)
+        df = store.dataframe(full=True)
+
+        self.assertEqual(df['info'].tolist(), self.raw_df['info'].tolist())
+        self.assertEqual(df['tweets'].tolist(),
+                         self.raw_df['tweets'].tolist())
+        self.assertEqual(df['list'][1], self.raw_df['list'][1])
+        self.assertEqual(df['list'][2], [])
+
+        # The optional copies don't change the digest
+        self.assertEqual(store.digest(), self.write('raw').digest())
+
+    def test_full_objects_are_opt_in(self):
+        store = self.write('raw')
+
+        self.assertFalse([fn for fn in os.listdir(store.path)
+                          if '.json.' in fn])
+        self.assertRaises(ValueError, store.dataframe, full=True)
+
+    def test_pickles_path_only(self):
+        store = self.write('raw')
+        copy = pickle.loads(pickle.dumps(store))
+
+        self.assertEqual(copy.path, store.path)
+        self.assertEqual(len(copy), len(self.raw_df))
+        self.assertEqual(copy.digest(), store.digest())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import unittest
+import networkx as nx
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'gravitty'))
+
+import community
+
+ENGINES = ('networkx', 'array')
+
+
+class LouvainStatsTest(unittest.TestCase):
+
+    def test_pass_seconds_are_durations(self):
+        graph = nx.karate_club_graph()
+
+        for engine in ENGINES:
+            stats = []
+            community.generate_dendrogram(graph, engine=engine, stats=stats)
+
+            self.assertTrue(stats)
+            for entry in stats:
+                self.assertTrue(0 <= entry['seconds'] < 10, (engine, entry))
+
+
+def weighted_graphs():
+    ''' Small graphs with known community structure, some weighted. '''
+
+    karate = nx.karate_club_graph()
+    weighted = nx.karate_club_graph()
+    for u, v in weighted.edges():
+        weighted[u][v]['weight'] = (u * v) % 5 + 1
+
+    return [karate, weighted, nx.connected_caveman_graph(6, 5)]
+
+
+class ArrayEngineTest(unittest.TestCase):
+
+    def assertValidPartition(self, partition, graph):
+        self.assertEqual(sorted(partition), sorted(graph.nodes()))
+        self.assertEqual(sorted(set(partition.values())),
+                         range(len(set(partition.values()))))
+
+    def test_partitions_are_valid(self):
+        for graph in weighted_graphs():
+            dendrogram = community.generate_dendrogram(graph, engine='array')
+
+            self.assertValidPartition(dendrogram[0], graph)
+            for lower, upper in zip(dendrogram[:-1], dendrogram[1:]):
+                self.assertEqual(sorted(upper), sorted(set(lower.values())))
+
+    def test_matches_networkx_modularity(self):
+        for graph in weighted_graphs():
+            expected = community.best_partition(graph)
+            found = community.best_partition(graph, engine='array')
+
+            self.assertValidPartition(found, graph)
+            self.assertAlmostEqual(community.modularity(found, graph),
+                                   community.modularity(expected, graph))
+
+    def test_initial_partition(self):
+        graph = weighted_graphs()[1]
+        part_init = {node: node % 3 for node in graph}
+
+        expected = community.best_partition(graph, part_init)
+        found = community.best_partition(graph, part_init, engine='array')
+
+        self.assertAlmostEqual(community.modularity(found, graph),
+                               community.modularity(expected, graph))
+
+
+
+class LevelModularityTest(unittest.TestCase):
+
+    def test_matches_modularity(self):
+        looped = nx.karate_club_graph()
+        looped.add_edge(0, 0, weight=3)
+        looped.add_edge(33, 33, weight=1)
+
+        for graph in weighted_graphs() + [looped]:
+            dendrogram = community.generate_dendrogram(graph)
+            dendrogram.append({k: 0 for k in dendrogram[-1].values()})
+
+            nodes, adjacency = community.graph_to_csr(graph)
+            partitions = community.partitions_at_levels(dendrogram, nodes)
+            found = community.modularity_at_levels(partitions, adjacency)
+
+            self.assertEqual(len(found), len(dendrogram))
+            for level in xrange(len(dendrogram)):
+                partition = community.partition_at_level(dendrogram, level)
+
+                self.assertEqual(partitions[level].tolist(),
+                                 [partition[node] for node in nodes])
+                self.assertAlmostEqual(found[level],
+                                       community.modularity(partition, graph))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import unittest
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'gravitty'))
+
+from parse import parse_dataframe
+
+
+def raw_dataframe():
+    '''
+    Small synthetic raw dataframe covering the tweet shapes the parsers
+    handle: flat and nested fields, unicode and byte string hashtags,
+    non english tweets and users without a timeline or lists.
+    '''
+
+    timelines = [
+        [{'id': 1, 'text': u'caf\xe9 #Caf\xe9', 'lang': 'en',
+          'hashtags': [u'Caf\xe9', u'Python', u'2014'],
+          'urls': [[u'http://a.co/1', u'http://example.com/1']],
+          'user_mentions': [{'id': 2, 'screen_name': u'two'}]},
+         {'id': 2, 'text': u'hola', 'lang': 'es', 'hashtags': ['Hola'],
+          'urls': [[u'http://a.co/2', u'http://example.com/2']],
+          'user_mentions': []}],
+        # Fields only found in nested dictionaries
+        [{'id': 3, 'lang': 'en', 'text': u'hi',
+          'user': {'mentions': [{'id': 1}, {'id': 99}]},
+          'entities': {'x': 1}, 'hashtags': ['Z\xc3\xbcrich', 'NYC']},
+         {'id': 4, 'lang': 'en', 'text': u'again', 'hashtags': [],
+          'urls': [[u'http://a.co/3']], 'user_mentions': [{'id': 1}]}],
+        [],
+        np.nan,
+    ]
+
+    rows = [{'info': {'screen_name': u'user%d' % i, 'name': u'U%d' % i},
+             'tweets': tweets, 'followers': [i + 1], 'following': [50, i],
+             'list': [{'id': 7}] if i % 2 else np.nan}
+            for i, tweets in enumerate(timelines)]
+
+    return pd.DataFrame(rows, index=range(1, len(rows) + 1))
+
+
+class SinglePassParseTest(unittest.TestCase):
+
+    def test_matches_field_by_field_parse(self):
+        raw_df = raw_dataframe()
+
+        expected = parse_dataframe(raw_df, single_pass=False)
+        found = parse_dataframe(raw_df)
+
+        self.assertEqual(found.columns.tolist(), expected.columns.tolist())
+        for column in expected.columns:
+            self.assertEqual(found[column].tolist(),
+                             expected[column].tolist(), column)
+
+    def test_empty_dataframe(self):
+        raw_df = raw_dataframe().iloc[:0]
+
+        self.assertEqual(parse_dataframe(raw_df).columns.tolist(),
+                         parse_dataframe(raw_df, single_pass=False)
+                         .columns.tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
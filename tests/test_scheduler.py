@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import unittest
+import twitter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'gravitty'))
+
+from scheduler import ApiScheduler
+
+WINDOW = 900
+
+
+class FakeClock(object):
+    ''' Clock that only moves when the scheduler sleeps. '''
+
+    def __init__(self):
+        self.now = 1000.
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class FakeApi(object):
+    '''
+    Local fake of the twitter api: GetUser costs one request of a per-key
+    quota, refilled every window, and fails with error 88 once it is used
+    up, like twitter does.
+    '''
+
+    def __init__(self, name, clock, limit=3, used=0):
+        self.name = name
+        self.clock = clock
+        self.limit = limit
+        self.used = used
+        self.reset = clock() + WINDOW
+        self.calls = 0
+
+    def __refill(self):
+        if self.clock() >= self.reset:
+            self.used = 0
+            self.reset = self.clock() + WINDOW
+
+    def GetRateLimitStatus(self):
+        self.__refill()
+        return {'resources': {'users': {'/users/show/:id': {
+            'limit': self.limit, 'remaining': self.limit - self.used,
+            'reset': self.reset}}}}
+
+    def GetUser(self, user_id=None):
+        self.__refill()
+        self.calls += 1
+
+        if self.used >= self.limit:
+            raise twitter.error.TwitterError(
+                [{'message': 'Rate limit exceeded', 'code': 88}])
+
+        self.used += 1
+        return self.name, user_id
+
+
+class ApiSchedulerTest(unittest.TestCase):
+
+    def scheduler(self, apis, clock, seed=True):
+        return ApiScheduler(apis, limits={'GetUser': 3}, window=WINDOW,
+                            clock=clock, sleep=clock.sleep, seed=seed)
+
+    def test_routes_to_key_with_most_requests_left(self):
+        clock = FakeClock()
+        a, b = FakeApi('a', clock, used=2), FakeApi('b', clock)
+        scheduler = self.scheduler([a, b], clock)
+
+        names = [scheduler.GetUser(user_id=i)[0] for i in range(4)]
+
+        self.assertEqual(sorted(names), ['a', 'b', 'b', 'b'])
+        self.assertEqual(names[0], 'b')
+        self.assertEqual(a.calls + b.calls, 4)
+        self.assertEqual(clock.slept, [])
+
+    def test_seeding_avoids_rate_limit_errors_after_restart(self):
+        clock = FakeClock()
+        a = FakeApi('a', clock, used=3)
+        b = FakeApi('b', clock)
+        scheduler = self.scheduler([a, b], clock)
+
+        self.assertEqual(scheduler.GetUser(user_id=1)[0], 'b')
+        self.assertEqual(a.calls, 0)
+
+    def test_rate_limit_error_moves_call_to_other_key(self):
+        clock = FakeClock()
+        a = FakeApi('a', clock, used=3)
+        b = FakeApi('b', clock, used=1)
+        scheduler = self.scheduler([a, b], clock, seed=False)
+
+        names = [scheduler.GetUser(user_id=i)[0] for i in range(2)]
+
+        self.assertEqual(names, ['b', 'b'])
+        self.assertEqual(a.calls, 1)
+        self.assertEqual(scheduler.status()['GetUser'][0][0], 0)
+
+    def test_waits_for_earliest_reset_when_every_key_is_exhausted(self):
+        clock = FakeClock()
+        a, b = FakeApi('a', clock), FakeApi('b', clock)
+        b.reset -= 300
+        scheduler = self.scheduler([a, b], clock)
+
+        names = [scheduler.GetUser(user_id=i)[0] for i in range(7)]
+
+        self.assertEqual(clock.slept, [WINDOW - 300])
+        self.assertEqual(names[-1], 'b')
+        self.assertEqual(a.calls + b.calls, 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
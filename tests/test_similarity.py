@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import unittest
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'gravitty'))
+
+from similarity import make_similarity_dataframe, make_similarity_matrix
+from vocab import intern_dataframe
+
+# The analyzed account, followed by every user
+TARGET = 99
+
+
+def parsed_dataframe(users=20, seed=0):
+    '''
+    Small synthetic stand-in for parse_dataframe's output: random feature
+    sets overlapping enough for most pairs to share something.
+    '''
+
+    random = np.random.RandomState(seed)
+    ids = range(1, users + 1)
+
+    def sample(pool, most):
+        return set(random.choice(pool, random.randint(0, most + 1),
+                                 replace=False).tolist())
+
+    rows = [{'followers': sample(ids + [50, 51, 52], 5),
+             'following': sample(ids + [60, 61], 5) | set([TARGET]),
+             'list': sample([70, 71, 72, 73], 2),
+             'mentions': sample(ids + [80, 81], 3),
+             'hashtags': sample(['a', 'b', 'c', 'd'], 2),
+             'urls': sample(['u1', 'u2', 'u3'], 1)}
+            for _ in ids]
+
+    return pd.DataFrame(rows, index=ids)
+
+
+class VectorizedSimilarityTest(unittest.TestCase):
+
+    def setUp(self):
+        self.df = parsed_dataframe()
+        self.expected = make_similarity_dataframe(self.df, vectorized=False)
+
+    def assertScoresEqual(self, found):
+        self.assertEqual(found.index.tolist(), self.expected.index.tolist())
+        np.testing.assert_allclose(found.values, self.expected.values)
+
+    def test_matches_compute_similarity(self):
+        self.assertTrue((self.expected.values > 0).any())
+        self.assertScoresEqual(make_similarity_dataframe(self.df))
+
+    def test_interned_features(self):
+        interned, _ = intern_dataframe(self.df)
+        self.assertScoresEqual(make_similarity_matrix(interned).to_dataframe())
+
+    def test_workers(self):
+        self.assertScoresEqual(make_similarity_dataframe(self.df, workers=2))
+
+
+if __name__ == '__main__':
+    unittest.main()